@@ -1,8 +1,48 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """
-   This module provides only 2 methods, XMLin and XMLout.
+   This module provides 2 main methods, XMLin and XMLout.
    XMLin convert xml to python object, and XMLout python object to xml.
+   XMLiter yields the elements found at a path like 'opt/item' one by one,
+   each collapsed in the same way as XMLin, to handle huge documents.
+   XMLout(tree, options, file=fp) writes xml into fp piece by piece, and
+   XMLout_iter(tree, options, chunk_size) yields it in encoded chunks.
+   Converter(options) normalizes options once and provides loads/dumps,
+   for converting many documents with the same options. Each call runs
+   in a context of its own, so one Converter may be shared by threads.
+   XMLin_many and XMLout_many convert many documents in a pool of
+   worker processes and yield the results in order or as they are done.
+   XMLin_parallel parses one big document of many children of the root
+   in slices, in worker processes, building the same tree as XMLin.
+   XMLin accepts a string of xml, a file path, an open file or any
+   iterable of byte chunks, which are fed to the parser block by block.
+   XMLin_file(path, options) maps the file in memory and feeds the parser
+   with slices of the mapping, never copying the file into a string.
+   PushParser(options, path=None) parses xml given piece by piece with
+   feed and close, for event loops which must not block on a whole
+   document; XMLout_iter gives the xml back in chunks to write in turn.
+   With the records option, repeated elements of the same attributes are
+   returned as compact read-only Record mappings instead of dicts.
+   The stats option (a dict to add counters to, or a callable taking
+   them) records phase timings, counts of elements, attributes, text,
+   keyattr folds and fallbacks, and the maximum depth of each call.
+   With the lazy option XMLin returns a LazyDict, which collapses the
+   value of each element only when it is first read.
+   The select and skip options take paths of elements like 'opt/item' or
+   '**/debug' ('*' matches an element, '**' any number of them); elements
+   out of select or in skip are dropped while parsing, never built.
+   The cache option ('memshare' or 'memcopy') keeps trees by the sha1 of
+   the xml and the options in MemCache, limited in entries and bytes,
+   returning the shared tree or a copy of it on the next XMLin.
+   With 'storable', a pickled snapshot of the tree for a file path is
+   kept next to the file (or in cachedir) and used while the file and
+   the options are unchanged.
+   publish(tree, name) writes a tree into shared memory (/dev/shm/name),
+   and attach(name) in any process returns a read-only view of it, which
+   decodes values on access instead of unpickling a copy of the tree.
+   The order option of XMLout writes the keys of hashes 'sorted' (the
+   default), in 'insertion' order, or as listed by element name in a
+   dictionary; the order for each set of keys is worked out only once.
 
    This module is inspired by XML::Simple in CPAN,
    but some options of XML::Simple are not supported.
@@ -34,8 +74,10 @@
 In current version, following options are supported
 [XMLin]
   keyattr keeproot forcecontent contentkey noattr forcearray grouptags normalizespace valueattr
+  engine parser intern records stats lazy select skip cache cachedir
 [XMLout]
   keyattr keeproot contentkey noattr rootname xmldecl noescape grouptags valueattr
+  escapecache stats order
 """
 
 __author__  = "Matsumoto Taichi (taichino@gmail.com)"
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+   Benchmark of XMLin and XMLout over synthetic documents (wide, deep,
+   attribute-heavy, text-heavy, keyattr, grouptags and valueattr), and
+   of XMLout over trees of growing depth and width, reporting
+   documents/sec, MB/sec and peak memory of each case. The peak memory
+   of each case is measured in an interpreter of its own.
+
+        $ python -m pyxml2obj.bench --save baseline.json
+        $ python -m pyxml2obj.bench --compare baseline.json
+
+   --compare exits with status 1 when a case got slower, or its peak
+   memory grew, beyond the baseline by more than --tolerance.
+"""
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+import sys
+from pyxml2obj.bench.runner import main
+
+sys.exit(main())
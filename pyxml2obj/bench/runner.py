@@ -0,0 +1,257 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# runs XMLin with each engine and parser, and XMLout, over the workloads
+# and XMLout over trees of growing depth and width, and reports
+# documents/sec, MB/sec and peak memory of each case. the numbers may be
+# saved as a baseline and later runs compared with it
+#
+#   $ python -m pyxml2obj.bench --save baseline.json
+#   $ python -m pyxml2obj.bench --compare baseline.json
+
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from optparse import OptionParser, SUPPRESS_HELP
+import pyxml2obj
+from pyxml2obj import XMLin, XMLout
+from pyxml2obj.bench.workloads import Workloads, Sweeps
+
+Parsers   = ('sax', 'expat', 'iterparse')
+Engines   = ('tree', 'onepass')
+DefSize   = 5000
+DefTime   = 0.2
+Tolerance = 0.2
+
+def make_cases(size, pattern=None):
+  # (name, function, bytes of xml handled by one call, nodes of a sweep).
+  # the bytes of XMLout cases are None, left to the caller to take from
+  # the output, and only the inputs of cases matching pattern are made,
+  # so a process measuring the memory of a case has run nothing else
+  def wanted(name):
+    return not pattern or pattern in name
+
+  cases = []
+  for name, generate, opt_in, opt_out in Workloads:
+    names = ['XMLin %s %s/%s' % (name, parser, engine)
+             for parser in Parsers for engine in Engines]
+    if not filter(wanted, names + ['XMLout %s' % name]):
+      continue
+    if callable(opt_in):
+      opt_in = opt_in(size)
+    if callable(opt_out):
+      opt_out = opt_out(size)
+    xml = generate(size)
+    for parser in Parsers:
+      for engine in Engines:
+        case = 'XMLin %s %s/%s' % (name, parser, engine)
+        if wanted(case):
+          options = dict(opt_in, parser=parser, engine=engine)
+          cases.append((case, (lambda xml=xml, options=options: XMLin(xml, options)),
+                        len(xml), None))
+    if wanted('XMLout %s' % name):
+      tree = XMLin(xml, opt_in)
+      cases.append(('XMLout %s' % name,
+                    (lambda tree=tree, options=opt_out: XMLout(tree, options)),
+                    None, None))
+  # sweeps have sizes of their own, --size does not change them
+  options = {'keyattr' : []}
+  for name, make_tree, counts in Sweeps:
+    for count in counts:
+      case = 'XMLout %s %d' % (name, count)
+      if wanted(case):
+        cases.append((case, (lambda tree=make_tree(count): XMLout(tree, options)),
+                      None, count))
+  return cases
+
+def measure(func, mintime=DefTime):
+  # seconds per call, the best of 3 rounds of at least mintime each
+  number = 1
+  while True:
+    elapsed = time_calls(func, number)
+    if elapsed >= mintime:
+      break
+    number *= 2
+  best = elapsed
+  for i in range(2):
+    best = min(best, time_calls(func, number))
+  return best / number
+
+def time_calls(func, number):
+  gc.collect()
+  start = time.time()
+  for i in xrange(number):
+    func()
+  return time.time() - start
+
+def current_rss():
+  # resident kilobytes of this process, where /proc is available
+  try:
+    fp = open('/proc/self/statm')
+    try:
+      pages = int(fp.read().split()[1])
+    finally:
+      fp.close()
+  except (IOError, IndexError, ValueError):
+    return 0
+  return pages * resource.getpagesize() / 1024
+
+def peak_rss():
+  # peak resident kilobytes of this process
+  try:
+    fp = open('/proc/self/status')
+    try:
+      for line in fp:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1])
+    finally:
+      fp.close()
+  except (IOError, IndexError, ValueError):
+    pass
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    peak /= 1024
+  return peak
+
+def reset_peak_rss():
+  # start the peak over from the current rss, where linux allows it.
+  # elsewhere the peak of making the input counts too
+  try:
+    fp = open('/proc/self/clear_refs', 'w')
+    try:
+      fp.write('5')
+    finally:
+      fp.close()
+  except (IOError, OSError):
+    pass
+
+def warm_up():
+  # load the modules and fill the caches every case needs on its first
+  # call, with a document too small to leave memory behind for the case
+  # to reuse
+  xml = '<opt a="1"><item name="x">text</item><item name="y" /></opt>'
+  for parser in Parsers:
+    for engine in Engines:
+      XMLout(XMLin(xml, {'parser' : parser, 'engine' : engine}))
+
+def call_peak(func):
+  # kilobytes of peak rss added by one call of func, once warmed up
+  warm_up()
+  gc.collect()
+  reset_peak_rss()
+  base = current_rss()
+  func()
+  return max(peak_rss() - base, 0)
+
+def peak_memory(name, size):
+  # kilobytes of peak rss added by one call of the named case, run in a
+  # fresh interpreter which has made the input and warmed up on a small
+  # document and nothing else, so no case is measured with the memory
+  # left by the others, nor with the cost of the first imports
+  env = dict(os.environ)
+  root = os.path.dirname(os.path.dirname(os.path.abspath(pyxml2obj.__file__)))
+  env['PYTHONPATH'] = os.pathsep.join([root] + filter(None, [env.get('PYTHONPATH')]))
+  proc = subprocess.Popen([sys.executable, '-m', 'pyxml2obj.bench',
+                           '--size', str(size), '--peak', name],
+                          stdout=subprocess.PIPE, env=env)
+  data = proc.communicate()[0]
+  if proc.returncode:
+    return None
+  try:
+    return int(data)
+  except ValueError:
+    return None
+
+def run(cases, size, mintime=DefTime, out=sys.stdout):
+  results = {}
+  for name, func, length, nodes in cases:
+    if length is None:
+      length = len(func())
+    seconds = measure(func, mintime)
+    result = results[name] = {
+      'docs_per_sec' : 1.0 / seconds,
+      'mb_per_sec'   : length / seconds / 1e6,
+      'peak_kb'      : peak_memory(name, size),
+      }
+    line = '%-36s %10.2f docs/sec %8.2f MB/sec %8s KB' % \
+        (name, result['docs_per_sec'], result['mb_per_sec'], result['peak_kb'])
+    if nodes:
+      result['usec_per_node'] = seconds / nodes * 1e6
+      line += ' %8.2f usec/node' % result['usec_per_node']
+    out.write(line + '\n')
+    out.flush()
+  return results
+
+def compare(results, baseline, tolerance=Tolerance, out=sys.stdout):
+  # returns the names of cases slower than the baseline, or using more
+  # peak memory, by more than tolerance (as a ratio of documents/sec or
+  # of kilobytes)
+  regressions = []
+  for name in sorted(results):
+    if name not in baseline:
+      continue
+    ratio = results[name]['docs_per_sec'] / baseline[name]['docs_per_sec']
+    mark = ''
+    if ratio < 1 - tolerance:
+      mark = '  REGRESSION'
+    peak, base = results[name].get('peak_kb'), baseline[name].get('peak_kb')
+    if peak is not None and base:
+      memory = '%7.2fx' % (float(peak) / base)
+      if float(peak) / base > 1 + tolerance:
+        mark = '  REGRESSION'
+    else:
+      memory = '%8s' % '-'
+    if mark:
+      regressions.append(name)
+    out.write('%-36s %7.2fx time %s memory%s\n' % (name, ratio, memory, mark))
+  return regressions
+
+def main(argv=None):
+  parser = OptionParser(usage='%prog [options]')
+  parser.add_option('-n', '--size', type='int', default=DefSize,
+                    help='records per document (default %d)' % DefSize)
+  parser.add_option('-t', '--time', type='float', default=DefTime,
+                    help='least seconds per round (default %.1f)' % DefTime)
+  parser.add_option('-k', '--filter', help='run the cases including this')
+  parser.add_option('-s', '--save', metavar='FILE', help='save results as a baseline')
+  parser.add_option('-c', '--compare', metavar='FILE', help='compare with a baseline')
+  parser.add_option('--tolerance', type='float', default=Tolerance,
+                    help='slowdown or memory growth allowed by --compare '
+                         '(default %.1f)' % Tolerance)
+  # measures the peak memory of one case, run by peak_memory
+  parser.add_option('--peak', help=SUPPRESS_HELP)
+  opts, args = parser.parse_args(argv)
+
+  sys.setrecursionlimit(10000)
+  if opts.peak:
+    for name, func, length, nodes in make_cases(opts.size, opts.peak):
+      if name == opts.peak:
+        print call_peak(func)
+        return 0
+    parser.error('no case named %r' % opts.peak)
+  results = run(make_cases(opts.size, opts.filter), opts.size, opts.time)
+  if opts.save:
+    fp = open(opts.save, 'w')
+    try:
+      json.dump({'size' : opts.size, 'results' : results}, fp, indent=1, sort_keys=True)
+    finally:
+      fp.close()
+  if opts.compare:
+    fp = open(opts.compare)
+    try:
+      baseline = json.load(fp)
+    finally:
+      fp.close()
+    if baseline['size'] != opts.size:
+      parser.error('baseline was taken with --size %d' % baseline['size'])
+    print
+    if compare(results, baseline['results'], opts.tolerance):
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# synthetic documents for the benchmark. each generator takes a size and
+# returns a string of xml, which grows about linearly with the size
+
+def wide_xml(count):
+  # many small records of the same shape under the root
+  items = ['<item id="%d" lang="en" type="record"><name>item %d</name>'
+           '<value>%d</value></item>' % (i, i, i) for i in range(count)]
+  return '<opt>\n' + '\n'.join(items) + '\n</opt>\n'
+
+def deep_xml(count):
+  # nested chains of elements, 50 levels each
+  depth = 50
+  chain = '<level n="%d">' * depth + 'leaf' + '</level>' * depth
+  chain = chain % tuple(range(depth))
+  return '<opt>' + ''.join([chain for i in range(max(count / depth, 1))]) + '</opt>'
+
+def attribute_xml(count):
+  # few elements carrying many attributes
+  attrs = ' '.join(['attr%d="value %d &amp; more"' % (i, i) for i in range(30)])
+  items = ['<item %s />' % attrs for i in range(max(count / 30, 1))]
+  return '<opt>' + ''.join(items) + '</opt>'
+
+def text_xml(count):
+  # long text contents with markup to escape
+  text = 'some text &lt;with&gt; markup &amp; entities, ' * 40
+  items = ['<para>%s</para>' % text for i in range(max(count / 40, 1))]
+  return '<opt>' + ''.join(items) + '</opt>'
+
+def keyattr_xml(count):
+  # records folded into a hash by their name attribute
+  items = ['<server name="host%d" osname="linux" address="10.0.%d.%d" />'
+           % (i, i / 256 % 256, i % 256) for i in range(count)]
+  return '<opt>' + ''.join(items) + '</opt>'
+
+def grouptags_xml(count):
+  # lists wrapped in a grouping element
+  dirs = ''.join(['<dir>/usr/local/bin%d</dir>' % i for i in range(count)])
+  return '<opt><dirs>%s</dirs></opt>' % dirs
+
+def valueattr_xml(count):
+  # named elements holding their value in a single attribute
+  items = ''.join(['<entry%d value="%d" />' % (i, i) for i in range(count)])
+  return '<opt>%s</opt>' % items
+
+def valueattr_options(count):
+  return {'valueattr' : dict([('entry%d' % i, 'value') for i in range(count)])}
+
+# (name, generator, options for XMLin, options for XMLout). options given
+# as a function are made from the size
+Workloads = [
+  ('wide',      wide_xml,      {'keyattr' : []}, {'keyattr' : []}),
+  ('deep',      deep_xml,      {}, {}),
+  ('attribute', attribute_xml, {}, {}),
+  ('text',      text_xml,      {}, {}),
+  ('keyattr',   keyattr_xml,   {'keyattr' : ['name']}, {'keyattr' : ['name']}),
+  ('grouptags', grouptags_xml, {'grouptags' : {'dirs' : 'dir'}},
+                               {'grouptags' : {'dirs' : 'dir'}}),
+  ('valueattr', valueattr_xml, valueattr_options, valueattr_options),
+  ]
+
+# trees for XMLout sweeps, made from a count of nodes
+
+def deep_tree(depth):
+  # {'level': {'level': ... {'value': '1'}}}
+  tree = {'value' : '1'}
+  for i in range(depth):
+    tree = {'level' : tree}
+  return tree
+
+def wide_tree(width):
+  # {'item': [{...}, {...}, ...]} with equal items
+  return {'item' : [{'attr1' : 'value1', 'attr2' : 'value2'} for i in range(width)]}
+
+# (name, tree maker, node counts). time per node should stay flat over
+# the counts, as serializing is linear in depth and width
+Sweeps = [
+  ('depth', deep_tree, (100, 200, 400, 800)),
+  ('width', wide_tree, (10000, 20000, 40000, 80000)),
+  ]
@@ -1,216 +1,802 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import sys
 import warnings
+import os
 import re
+import time
+import mmap
+import hashlib
+import tempfile
+import struct
+import threading
+import fnmatch
+import multiprocessing
+import cPickle
+from collections import deque, OrderedDict
 from xml.sax import *
+from xml.parsers import expat
+try:
+  import xml.etree.cElementTree as etree
+except ImportError:
+  import xml.etree.ElementTree as etree
+
+DefChunkSize = 8
+DefSliceSize = 1024 * 1024
+DefMapSize   = 1024 * 1024
 
 def XMLin(content, options={}):
+  # content may be a string of xml, a path to a file, an open (binary) file
+  # or any iterable of byte chunks. anything but a string of xml is fed to
+  # the parser block by block, so the raw text is never held as a whole
+  obj = xml2obj(options)
+  return obj.XMLin(content)
+
+def XMLin_file(path, options={}, mmap=True):
+  # with mmap, the file is mapped and the parser fed with slices of the
+  # mapping, so its contents are never copied into a string. the cache
+  # option keeps the tree by path either way
   obj = xml2obj(options)
-  obj.XMLin(content)
-  return obj.tree
+  ctx = obj.context('in')
+  return obj.build_tree(ctx, path, iter_mapped(path) if mmap else None)
+
+def XMLiter(content, path, options={}):
+  # yield each element found at path (like 'opt/item') collapsed one by one
+  obj = xml2iter(path, options)
+  return obj.XMLiter(content)
 
-def XMLout(tree, options={}):
+def XMLout_iter(tree, options={}, chunk_size=None, encoding='utf-8'):
+  # yield the xml lazily in encoded chunks of about chunk_size bytes
   obj = xml2obj(options)
-  xml = obj.XMLout(tree)
+  return obj.XMLout_iter(tree, chunk_size=chunk_size, encoding=encoding)
+
+def XMLout(tree, options={}, file=None):
+  # with file, xml is written into the file-like object piece by piece
+  # and nothing is returned
+  obj = xml2obj(options)
+  xml = obj.XMLout(tree, file=file)
   return xml
 
+def XMLin_many(sources, options={}, workers=None, chunksize=DefChunkSize,
+               ordered=True):
+  # convert many documents in a pool of worker processes, yielding the
+  # trees in the order of sources (or as they are done, with ordered=False).
+  # sources must be picklable, so strings of xml or file paths
+  return convert_many('in', sources, options, workers, chunksize, ordered)
+
+def XMLout_many(trees, options={}, workers=None, chunksize=DefChunkSize,
+                ordered=True):
+  # the counterpart of XMLin_many, yielding the xml of each tree
+  return convert_many('out', trees, options, workers, chunksize, ordered)
+
+def publish(tree, name):
+  # write tree in a compact binary form into the file name (a bare name
+  # is put in /dev/shm, in memory). processes attaching to it share the
+  # pages of the file instead of holding a tree each
+  path = shared_path(name)
+  dirname, basename = os.path.split(path)
+  fd, temp = tempfile.mkstemp(prefix='.' + basename, dir=dirname)
+  try:
+    fp = os.fdopen(fd, 'wb')
+    try:
+      shared_writer(fp).write_tree(tree)
+    finally:
+      fp.close()
+    os.rename(temp, path)
+  except:
+    os.remove(temp)
+    raise
+  return path
+
+def attach(name):
+  # read-only view of a tree written by publish. values are decoded from
+  # the shared mapping when they are read, and nothing is copied before
+  fp = open(shared_path(name), 'rb')
+  try:
+    mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+  finally:
+    fp.close()
+  if mapped[:len(SharedMagic)] != SharedMagic:
+    mapped.close()
+    raise ValueError('%s is not a published tree' % (name,))
+  return shared_value(mapped, struct.unpack_from('<Q', mapped, len(SharedMagic))[0])
+
+def XMLin_parallel(content, options={}, workers=None, slicesize=DefSliceSize):
+  # parse one big document, made of many children of the root, in a pool
+  # of worker processes. content is a string of xml or a file path, and
+  # the tree is the same as XMLin would build. other sources, and
+  # documents too small to be cut, are parsed serially. the workers
+  # always collapse as the onepass engine does, and the lazy option is
+  # refused, as lazy trees can not be sent back by the workers
+  obj = xml2slices(options)
+  return obj.XMLin_parallel(content, workers, slicesize)
+
 StrictMode  = 0
 KnownOptIn  = 'keyattr keeproot forcecontent contentkey noattr \
-               forcearray grouptags normalizespace valueattr'.split()
+               forcearray grouptags normalizespace valueattr engine parser \
+               intern records stats lazy select skip cache cachedir'.split()
 KnownOptOut = 'keyattr keeproot contentkey noattr \
-               rootname xmldecl noescape grouptags valueattr'.split()
+               rootname xmldecl noescape grouptags valueattr escapecache stats \
+               order'.split()
+KnownOpt    = frozenset(KnownOptIn + KnownOptOut)
 DefKeyAttr     = 'name key id'.split()
 DefRootName    = 'root'
 DefContentKey  = 'content'
 DefXmlDecl     = "<?xml version='1.0' standalone='yes'?>"
+DefBlockSize   = 64 * 1024
+DefEngine      = 'tree'
+DefParser      = 'sax'
+DefInternLen   = 32
+DefCacheEntries = 256
+DefCacheBytes   = 64 * 1024 * 1024
+DefOrderCache   = 1024
+DefRecordClasses = 1024
+DefPathSteps    = 1024
+CacheSchemes    = ('storable', 'memshare', 'memcopy')
+# options which do not change the tree XMLin returns
+CacheNeutral    = frozenset(['cache', 'cachedir', 'stats', 'intern', 'parser', 'engine'])
+StorMagic       = 'pyxml2obj-stor 1\n'
+SharedMagic     = 'PYX2SHM1'
+SharedDir       = '/dev/shm'
+StatsIn  = 'elements attributes text_chars max_depth folds fallbacks \
+            cache_hits time_collapse time_fold'.split()
+StatsOut = 'chars'.split()
+
+class frozen_options(dict):
+  # normalized options may be shared by many calls, so never change them
+
+  def readonly(self, *args, **kws):
+    raise TypeError('normalized options are read-only')
+
+  __setitem__ = __delitem__ = readonly
+  clear = pop = popitem = setdefault = update = readonly
+
+  def __reduce__(self):
+    return (frozen_options, (dict(self),))
+
+class subtree(tuple):
+  # (value, name, depth) of a nested value yielded by xml2obj.xml_parts
+  pass
+
+def escape_attr(data):
+  if data is None:
+    return ''
+  if not isinstance(data, basestring):
+    data = str(data)
+  # checking each character with 'in' beats a single regex scan here
+  if '&' in data or '<' in data or '>' in data or '"' in data:
+    data = data.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+  return data
 
-class xml2obj(ContentHandler):
-
+def escape_text(data):
+  # quotes need no escaping outside of attribute values
+  if data is None:
+    return ''
+  if not isinstance(data, basestring):
+    data = str(data)
+  if '&' in data or '<' in data or '>' in data:
+    data = data.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+  return data
+
+class key_order(object):
+  # the order the keys of a hash are written in: the key attribute of the
+  # element first, then the others sorted, as the hash gives them
+  # ('insertion'), or as listed for the element in a dictionary, those
+  # not listed following them sorted. orders are remembered by element
+  # name and keys, so a list of hashes with the same keys is sorted once
+  # instead of once for each hash. up to cachesize of them are kept, when
+  # the cache is emptied
+
+  def __init__(self, order, keyattr, cachesize=DefOrderCache):
+    self.order = order
+    self.keyattr = keyattr
+    self.cachesize = cachesize
+    self.cache = {}
+
+  def keys(self, name, tree, extra=None):
+    # with extra, the order of the keys of tree and the key extra
+    keys = tuple(tree)
+    cache_key = (name, tree.__class__, keys, extra)
+    try:
+      return self.cache[cache_key]
+    except KeyError:
+      if len(self.cache) >= self.cachesize:
+        self.cache.clear()
+      all_keys = keys
+      if extra is not None and self.order == 'insertion':
+        # as a copy of tree with the key set gives them, which for a
+        # dict may not be the order of tree
+        hash = tree.copy()
+        hash[extra] = None
+        all_keys = tuple(hash)
+      elif extra is not None and extra not in keys:
+        all_keys = keys + (extra,)
+      order = self.cache[cache_key] = self.make_order(name, all_keys)
+      return order
+
+  def make_order(self, name, keys):
+    first = []
+    rest = list(keys)
+    if isinstance(self.keyattr, dict) and name in self.keyattr \
+          and self.keyattr[name][0] in rest:
+      first.append(self.keyattr[name][0])
+      rest.remove(first[0])
+
+    if isinstance(self.order, dict) and name in self.order:
+      listed = [key for key in self.order[name] if key in rest]
+      rest = listed + sorted(set(rest).difference(listed))
+    elif self.order != 'insertion':
+      rest.sort()
+    return tuple(first + rest)
+
+class escaper(object):
+  # escapes values for attributes and text. with cachesize, escaped
+  # strings are remembered until cachesize of them are stored, when
+  # the cache is emptied
+
+  def __init__(self, cachesize=0):
+    self.cachesize = cachesize
+    self.attr_cache = {}
+    self.text_cache = {}
+
+  def attr(self, data):
+    if self.cachesize and (data.__class__ is str or data.__class__ is unicode):
+      return self.cached(self.attr_cache, escape_attr, data)
+    return escape_attr(data)
+
+  def text(self, data):
+    if self.cachesize and (data.__class__ is str or data.__class__ is unicode):
+      return self.cached(self.text_cache, escape_text, data)
+    return escape_text(data)
+
+  def cached(self, cache, escape, data):
+    try:
+      return cache[data]
+    except KeyError:
+      if len(cache) >= self.cachesize:
+        cache.clear()
+      value = cache[data] = escape(data)
+      return value
+
+is_blank = re.compile(r'^\s*$').match
+ContentKeyPattern = re.compile(r'^-(.*)$')
+KeyAttrPattern    = re.compile(r'^(\+|-)?(.*)$')
+SpacesPattern     = re.compile(r'\s\s+')
+StartTagPattern   = re.compile(r'<([^\s/>]+)(?:\s+[^\s=]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*/?>')
+
+def iter_source(content, blocksize=DefBlockSize):
+  # string including markup is treated as xml, others as a file path.
+  # xml strings are fed in blocks too, so that the handler hears of the
+  # first elements before the parser went through the whole string
+  if isinstance(content, basestring):
+    if '<' in content:
+      if len(content) <= blocksize:
+        yield content
+        return
+      for start in xrange(0, len(content), blocksize):
+        yield content[start:start + blocksize]
+      return
+    fp = open(content, 'rb')
+    try:
+      for chunk in iter_source(fp, blocksize):
+        yield chunk
+    finally:
+      fp.close()
+  elif hasattr(content, 'read'):
+    while True:
+      chunk = content.read(blocksize)
+      if not chunk:
+        break
+      yield chunk
+  else:
+    for chunk in content:
+      yield chunk
+
+def iter_mapped(path, blocksize=DefMapSize):
+  # buffers over slices of the file mapped in memory. parsers read them
+  # in place, and pages already in the page cache are not read again
+  fp = open(path, 'rb')
+  try:
+    size = os.fstat(fp.fileno()).st_size
+    if not size:
+      # an empty file can not be mapped, and is no xml anyway
+      yield ''
+      return
+    mapped = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+  finally:
+    fp.close()
+  try:
+    for offset in xrange(0, size, blocksize):
+      yield buffer(mapped, offset, blocksize)
+  finally:
+    mapped.close()
+
+class context(object):
+  # the state of one conversion. xml2obj keeps nothing but its options
+  # between calls and hands a context down to everything it calls, so
+  # the same xml2obj (or Converter) may run any number of conversions at
+  # once, from any number of threads
+
+  def __init__(self, opt):
+    self.opt = opt
+    # counters of the conversion, when the stats option is given
+    self.counts = None
+    # record classes by element name, with the records option
+    self.shapes = {}
+    self.intern = opt.get('intern')
+    if self.intern is True:
+      self.intern = InternTable()
+    self.cache_keys = {}
+    self.var_values = None
+    if 'valiables' in opt:
+      self.var_values = opt['variables']
+    elif 'varattr' in opt:
+      self.var_values = {}
+
+class xml2obj(object):
   def __init__(self, options={}):
-    known_opt = {}
-    for key in KnownOptIn + KnownOptOut:
-      known_opt[key] = None
-
     def_opt = {}
     for key, val in options.items():
       lkey = key.lower().replace('_', '')
-      if not lkey in known_opt:
+      if not lkey in KnownOpt:
         raise KeyError('%s is not acceptable' % (lkey,))
       def_opt[lkey] = val
     self.def_opt = def_opt
 
   def XMLin(self, content, options={}):
-    self.handle_options('in', options)
-    self.build_tree(content)
-
-  def build_tree(self, content):
-    parseString(content, self)
-
-  def handle_options(self, dirn, options):
-    known_opt = {}
-    if dirn == 'in':
-      for key in KnownOptIn:
-        known_opt[key] = key
+    ctx = self.context('in', options)
+    return self.build_tree(ctx, content)
+
+  def context(self, dirn, options={}):
+    return context(self.normalize_options(dirn, options))
+
+  def build_tree(self, ctx, content, source=None):
+    # with the cache option, content and options seen before are served
+    # from the cache of the first scheme keeping them, or parsed and
+    # saved with the first scheme. strings of xml and paths are cached,
+    # other sources are always parsed, with a warning. source, when
+    # given, is parsed in the place of content, which is then the key
+    if source is None:
+      source = content
+    if 'cache' in ctx.opt and not isinstance(content, basestring):
+      warnings.warn("'Cache' option ignored: only strings of xml and paths are cached")
+    elif 'cache' in ctx.opt:
+      start = time.time()
+      for scheme in ctx.opt['cache']:
+        try:
+          tree = getattr(self, 'cache_read_' + scheme)(ctx, content)
+        except KeyError:
+          continue
+        # a hit is a call parsing nothing
+        if 'stats' in ctx.opt:
+          ctx.counts = dict.fromkeys(StatsIn, 0)
+          ctx.counts['cache_hits'] = 1
+          self.report_stats(ctx, time.time() - start)
+        return tree
+      tree = self.parse_tree(ctx, source)
+      getattr(self, 'cache_save_' + ctx.opt['cache'][0])(ctx, content, tree)
+      return tree
+    return self.parse_tree(ctx, source)
+
+  def options_digest(self, ctx):
+    # sha1 of the options making a difference to the tree
+    return hashlib.sha1(repr(sorted([(key, val) for key, val in ctx.opt.items()
+                                     if key not in CacheNeutral])))
+
+  def content_key(self, ctx, content):
+    # sha1 of the options and the xml, and the size of the xml
+    if 'content' not in ctx.cache_keys:
+      digest = self.options_digest(ctx)
+      if '<' in content:
+        if isinstance(content, unicode):
+          content = content.encode('utf-8')
+        digest.update(content)
+        size = len(content)
+      else:
+        size = 0
+        for chunk in iter_source(content):
+          digest.update(chunk)
+          size += len(chunk)
+      ctx.cache_keys['content'] = (digest.hexdigest(), size)
+    return ctx.cache_keys['content']
+
+  def cache_read_memshare(self, ctx, content):
+    return MemCache.get(('memshare', self.content_key(ctx, content)[0]))
+
+  def cache_save_memshare(self, ctx, content, tree):
+    key, size = self.content_key(ctx, content)
+    MemCache.put(('memshare', key), tree, size)
+
+  def cache_read_memcopy(self, ctx, content):
+    # each caller gets a copy of its own, rebuilt from a pickle
+    return cPickle.loads(MemCache.get(('memcopy', self.content_key(ctx, content)[0])))
+
+  def cache_save_memcopy(self, ctx, content, tree):
+    data = cPickle.dumps(tree, 2)
+    MemCache.put(('memcopy', self.content_key(ctx, content)[0]), data, len(data))
+
+  def stor_header(self, ctx, path):
+    # what a snapshot of the file must have been made from, taken before
+    # the file is parsed so a change while parsing makes it stale
+    if 'stor' not in ctx.cache_keys:
+      path = os.path.abspath(path)
+      stat = os.stat(path)
+      if 'cachedir' in ctx.opt:
+        name = '%s-%s.stor' % (os.path.basename(path),
+                               hashlib.sha1(path).hexdigest()[:16])
+        stor = os.path.join(ctx.opt['cachedir'], name)
+      else:
+        stor = os.path.splitext(path)[0] + '.stor'
+      header = (path, stat.st_mtime, stat.st_size, self.options_digest(ctx).hexdigest())
+      ctx.cache_keys['stor'] = (stor, header)
+    return ctx.cache_keys['stor']
+
+  def cache_read_storable(self, ctx, content):
+    # a snapshot of the tree pickled next to the file (or in cachedir)
+    if '<' in content:
+      raise KeyError(content)
+    stor, header = self.stor_header(ctx, content)
+    try:
+      fp = open(stor, 'rb')
+      try:
+        if fp.read(len(StorMagic)) != StorMagic or cPickle.load(fp) != header:
+          raise KeyError(stor)
+        return cPickle.load(fp)
+      finally:
+        fp.close()
+    except Exception:
+      # missing, stale, truncated or otherwise unreadable snapshots are
+      # all misses
+      raise KeyError(stor)
+
+  def cache_save_storable(self, ctx, content, tree):
+    # written to a temporary file renamed over the snapshot, so readers
+    # see the old snapshot or the new one and never a part of it
+    if '<' in content:
+      return
+    stor, header = self.stor_header(ctx, content)
+    dirname, basename = os.path.split(stor)
+    try:
+      fd, temp = tempfile.mkstemp(prefix='.' + basename, dir=dirname or '.')
+    except OSError:
+      return
+    try:
+      fp = os.fdopen(fd, 'wb')
+      try:
+        fp.write(StorMagic)
+        cPickle.dump(header, fp, 2)
+        cPickle.dump(tree, fp, 2)
+      finally:
+        fp.close()
+      os.rename(temp, stor)
+    except (IOError, OSError):
+      if os.path.exists(temp):
+        os.remove(temp)
+
+  def parse_tree(self, ctx, content):
+    handler = self.make_handler(ctx)
+    start = time.time()
+    for step in self.parse_steps(ctx, content, handler):
+      pass
+    if ctx.counts is not None:
+      self.report_stats(ctx, time.time() - start)
+    return handler.tree
+
+  def parse_steps(self, ctx, content, handler):
+    # feed content to the parser chosen by the 'parser' option, which
+    # calls back the handler. yields each time a chunk has been parsed
+    if 'stats' in ctx.opt:
+      ctx.counts = dict.fromkeys(StatsIn, 0)
+    handler = self.wrap_handler(ctx, handler)
+    parser = ctx.opt.get('parser', DefParser)
+    if parser == 'iterparse':
+      for step in iterparse_steps(content, handler):
+        yield step
+      return
+    if parser == 'sax':
+      reader = make_parser()
+      reader.setContentHandler(handler)
+    elif parser == 'expat':
+      # expat interns names in a dict of its own, the table is left to
+      # the intern filter so that it counts the same with every parser
+      reader = expat_reader(handler)
     else:
-      for key in KnownOptOut:
-        known_opt[key] = key
+      raise ValueError("Illegal value for 'Parser' option - expected 'sax', 'expat' or 'iterparse'")
+    for chunk in iter_source(content):
+      reader.feed(chunk)
+      yield
+    reader.close()
+    yield
+
+  def wrap_handler(self, ctx, handler):
+    # put filters working on sax events in front of the handler
+    if ctx.intern is not None:
+      handler = intern_filter(handler, ctx.intern)
+    if ctx.counts is not None:
+      handler = stats_filter(handler, ctx.counts)
+    if 'select' in ctx.opt or 'skip' in ctx.opt:
+      handler = path_filter(handler, ctx.opt.get('select'), ctx.opt.get('skip'))
+    return handler
+
+  def report_stats(self, ctx, elapsed):
+    # hand the counters of this conversion to the stats option, a
+    # callable taking them or a dict adding them up over conversions
+    counts = ctx.counts
+    ctx.counts = None
+    counts['calls'] = 1
+    counts['time_total'] = elapsed
+    if 'time_collapse' in counts:
+      counts['time_parse'] = counts['time_total'] - counts['time_collapse']
+    add_stats(ctx.opt['stats'], counts)
+
+  def make_handler(self, ctx):
+    # 'tree' builds the whole list tree then collapses it at the end,
+    # 'onepass' collapses each element as soon as it is closed
+    engine = ctx.opt.get('engine', DefEngine)
+    if engine == 'tree':
+      return tree_builder(self, ctx)
+    if ctx.opt.get('lazy'):
+      raise ValueError("'Lazy' option needs the 'tree' engine")
+    if engine == 'onepass':
+      return onepass_builder(self, ctx)
+    raise ValueError("Illegal value for 'Engine' option - expected 'tree' or 'onepass'")
+
+  def normalize_options(self, dirn, options):
+    known_opt = KnownOptIn if dirn == 'in' else KnownOptOut
     
     row_opt = options
-    self.opt = {}
+    opt = {}
 
     for key, val in row_opt:
       lkey = key.lower().replace('_', '')
       if key not in known_opt:
         raise KeyError('%s is not acceptable'  (key,))
-      self.opt[lkey] = val
+      opt[lkey] = val
 
     # marge in options passed to constructor
     for key in known_opt:
-      if not key in self.opt:
+      if not key in opt:
         if key in self.def_opt:
-          self.opt[key] = self.def_opt[key]
+          opt[key] = self.def_opt[key]
 
     # set sensible defaults if not supplied
-    if 'rootname' in self.opt:
-      if not self.opt['rootname']:
-        self.opt['rootname'] = '';
+    if 'rootname' in opt:
+      if not opt['rootname']:
+        opt['rootname'] = '';
     else:
-      self.opt['rootname'] = DefRootName
+      opt['rootname'] = DefRootName
       
-    if 'xmldecl' in self.opt and str(self.opt['xmldecl']) == '1':
-      self.opt['xmldecl'] = DefXmlDecl
+    if 'xmldecl' in opt and str(opt['xmldecl']) == '1':
+      opt['xmldecl'] = DefXmlDecl
       
-    if 'contentkey' in self.opt:
-      m = re.match('^-(.*)$', self.opt['contentkey'])
+    if 'contentkey' in opt:
+      m = ContentKeyPattern.match(opt['contentkey'])
       if m:
-        self.opt['contentkey'] = m.group(1)
-        self.opt['collapseagain'] = 1
+        opt['contentkey'] = m.group(1)
+        opt['collapseagain'] = 1
     else:
-      self.opt['contentkey'] = DefContentKey
+      opt['contentkey'] = DefContentKey
       
-    if not 'normalizespace' in self.opt:
-      self.opt['normalizespace'] = 0
+    if not 'normalizespace' in opt:
+      opt['normalizespace'] = 0
 
     # special cleanup for forcearray
-    if 'forcearray' in self.opt:
-      if isinstance(self.opt['forcearray'], list):
-        force_list = self.opt['forcearray']
+    if 'forcearray' in opt:
+      if isinstance(opt['forcearray'], list):
+        force_list = opt['forcearray']
         if len(force_list) > 0:
-          self.opt['forcearray'] = {}
+          opt['forcearray'] = {}
           for tag in force_list:
-            self.opt['forcearray'][tag] = 1
+            opt['forcearray'][tag] = 1
         else:
-          self.opt['forcearray'] = 0
+          opt['forcearray'] = 0
     else:
-      self.opt['forcearray'] = 0
+      opt['forcearray'] = 0
 
     # special cleanup for keyattr
-    if 'keyattr' in self.opt:
-      if isinstance(self.opt['keyattr'], dict):
+    if 'keyattr' in opt:
+      if isinstance(opt['keyattr'], dict):
         # make a copy so we can mess with it
-        self.keyattr = self.opt['keyattr']
+        opt['keyattr'] = opt['keyattr'].copy()
 
         # Convert keyattr : {elem: '+attr'}
         # to keyattr : {elem: ['attr', '+']}
-        for el in self.opt['keyattr']:
-          m = re.match(r'^(\+|-)?(.*)$', self.opt['keyattr'][el])
+        for el in opt['keyattr'].keys():
+          m = KeyAttrPattern.match(opt['keyattr'][el])
           if m:
-            self.opt['keyattr'][el] = [m.group(2), m.group(1)]
-            if self.opt['forcearray'] == 1:
+            opt['keyattr'][el] = [m.group(2), m.group(1)]
+            if opt['forcearray'] == 1:
               continue
-            if isinstance(self.opt['forcearray'], dict) and el in self.opt['forcearray']:
+            if isinstance(opt['forcearray'], dict) and el in opt['forcearray']:
               continue
             if StrictMode and dirn == 'in':
               raise ValueError("<%s> set in KeyAttr but not in ForceArray" % (el,))
           else:
-            del self.opt['keyattr'][el]
-      elif isinstance(self.opt['keyattr'], list):
-        self.keyattr = self.opt['keyattr']
+            del opt['keyattr'][el]
+      elif isinstance(opt['keyattr'], list):
+        pass
       else:
-        self.opt['keyattr'] = [ self.opt['keyattr']];
+        opt['keyattr'] = [ opt['keyattr']];
     else:
       if StrictMode:
         raise ValueError("No value specified for 'KeyAttr' option in call to XML%s()" % (dirn,))
-      self.opt['keyattr'] = DefKeyAttr
+      opt['keyattr'] = DefKeyAttr
 
     # make sure there's nothing weired in grouptags
-    if hasattr(self.opt, 'grouptags'):
-      if not isinstance(self.opt['grouptags'], dict):
+    # (the writer does not recurse, so a tag grouped into itself would
+    # never end instead of running out of stack)
+    if 'grouptags' in opt:
+      if not isinstance(opt['grouptags'], dict):
         raise ValueError("Illegal value for 'GroupTags' option - expected a dictionary")
-      for key, val in self.opt['grouptags']:
+      for key, val in opt['grouptags'].items():
         if key == val:
           raise ValueError("Bad value in GroupTags: '%s' => '%s'" % (key, val))
 
-    if 'valiables' in self.opt:
-      self._var_values = self.opt['variables']
-    elif 'varattr' in self.opt:
-      self._var_values = {}
+    if dirn == 'out':
+      opt['escaper'] = escaper(opt.get('escapecache', 0))
+
+    # order : 'sorted', 'insertion' or a dictionary of element names to
+    # lists of keys
+    if dirn == 'out':
+      order = opt.get('order', 'sorted')
+      if not isinstance(order, dict) and order not in ('sorted', 'insertion'):
+        raise ValueError("Illegal value for 'Order' option - expected 'sorted', 'insertion' or a dictionary")
+      opt['keyorder'] = key_order(order, opt['keyattr'])
+
+    # intern : 1 shares names within the conversion, with a table of its
+    # own made by the context. pass an InternTable to share names and
+    # values over many conversions
+    if dirn == 'in' and 'intern' in opt:
+      if not opt['intern']:
+        del opt['intern']
+      elif not isinstance(opt['intern'], InternTable):
+        opt['intern'] = True
+
+    # cache : 'storable', 'memshare' or 'memcopy', or a list of them
+    if dirn == 'in' and 'cache' in opt:
+      schemes = opt['cache']
+      if isinstance(schemes, basestring):
+        schemes = [schemes]
+      for scheme in schemes:
+        if scheme not in CacheSchemes:
+          raise ValueError("Illegal value for 'Cache' option - expected %s" %
+                           ', '.join(["'%s'" % name for name in CacheSchemes]))
+      if schemes:
+        opt['cache'] = tuple(schemes)
+      else:
+        del opt['cache']
+
+    # paths of elements to keep or to drop, as a string or a list of them
+    for key in ('select', 'skip'):
+      if dirn == 'in' and key in opt:
+        if not opt[key]:
+          del opt[key]
+        elif not isinstance(opt[key], path_matcher):
+          opt[key] = path_matcher(opt[key])
+
+    return frozen_options(opt)
 
-  def collapse(self, attr, tree):
+  def collapse(self, ctx, attr, tree):
     # start with the hash of attributes
-    if 'noattr' in self.opt:
-      attr = {}
-    elif 'normalizespace' in self.opt and self.opt['normalizespace'] == 2:
-      for key, val in attr.items():
-        attr[key] = self.normalize_space(val)
+    attr = self.collapse_attr(ctx, attr)
 
     for key, val in zip(tree[::2],tree[1::2]):
       if isinstance(val, list):
-        val = self.collapse(val[0], val[1:])
-        if not val and 'suppressempty' in self.opt:
+        val = self.collapse(ctx, val[0], val[1:])
+        if not val and 'suppressempty' in ctx.opt:
           continue
       elif key == '0':
-        if re.match('^\s*$', val): # skip all whitespace content
+        if is_blank(val): # skip all whitespace content
           continue
         
         # do variable substitutions
-        if hasattr(self, '_var_values'):
+        if ctx.var_values is not None:
           re.sub('\$\{(\w+)\}', lambda match: self.get_var(match.group(1)))
           
         # look for variable definitions
-        if 'varattr' in self.opt:
-          var = self.opt['varattr']
+        if 'varattr' in ctx.opt:
+          var = ctx.opt['varattr']
           if attr.has_key(var):
             self.set_var(attr[var], val)
             
         # collapse text content in element with no attributes to a string
         if not len(attr) and val == tree[-1]:
-          return { self.opt['contentkey'] : val } if 'forcecontent' in self.opt else val
-        key = self.opt['contentkey']
+          return { ctx.opt['contentkey'] : val } if 'forcecontent' in ctx.opt else val
+        key = ctx.opt['contentkey']
 
-      # combine duplicate attributes
-      if attr.has_key(key):
-        if isinstance(attr[key], list):
-          attr[key].append(val)
-        else:
-          attr[key] = [attr[key], val]
-      elif val and isinstance(val, list):
-        attr[key] = [val]
-      else:
-        if 'contentkey' in self.opt and key != self.opt['contentkey'] and \
-              (self.opt['forcearray'] == 1 or \
-                 (isinstance(self.opt['forcearray'], dict) and key in self.opt['forcearray'])):
-            attr[key] = [val]
-        else:
-          attr[key] = val
+      self.merge(ctx, attr, key, val)
 
-    # turn array into hash if key fields present
-    if self.opt.has_key('keyattr'):
-      for key, val in attr.items():
-        if val and isinstance(val, list):
-          attr[key] = self.array_to_hash(key, val)
+    return self.finish(ctx, attr)
 
-    # disintermediate grouped tags
-    if self.opt.has_key('grouptags'):
-      for key, val in attr.items():
-        if not (isinstance(val, dict) and len(val) == 1):
+  def lazy_collapse(self, ctx, attr, tree):
+    # same as collapse, but only goes through the children of the element
+    # to see which keys it will have. the value of each key is left as a
+    # lazy_value to be collapsed when it is first read
+    attr = self.collapse_attr(ctx, attr)
+    keys = set(attr)
+    parts = {}
+
+    for key, val in zip(tree[::2],tree[1::2]):
+      if key == '0':
+        if is_blank(val):
           continue
-        if not self.opt['grouptags'].has_key(key):
+        if not len(keys) and val == tree[-1]:
+          return { ctx.opt['contentkey'] : val } if 'forcecontent' in ctx.opt else val
+        key = ctx.opt['contentkey']
+      keys.add(key)
+      parts.setdefault(key, []).append(val)
+
+    # a single anonymous array may become the value itself, so the
+    # whole element has to be collapsed to know
+    if keys == set(['anon']):
+      return self.collapse(ctx, attr, tree)
+
+    hash = LazyDict(attr)
+    for key, val in parts.iteritems():
+      hash[key] = lazy_value(self, ctx, key, attr.get(key, lazy_value), val)
+    return hash
+
+  def lazy_value(self, ctx, key, initial, parts):
+    # merge the parts of one key as collapse would, then finish the value
+    attr = {}
+    if initial is not lazy_value:
+      attr[key] = initial
+    for val in parts:
+      if isinstance(val, list):
+        val = self.lazy_collapse(ctx, val[0], val[1:])
+      self.merge(ctx, attr, key, val)
+    return self.finish_value(ctx, key, attr[key])
+
+  def fold(self, ctx, attr, pairs):
+    # same as collapse, but takes (name, value) pairs of which values are
+    # already collapsed. text content is given with the name '0' and
+    # whitespace only text may have already been dropped
+    attr = self.collapse_attr(ctx, attr)
+
+    for key, val in pairs:
+      if key == '0':
+        if is_blank(val):
           continue
-        child_key, child_val = val.popitem()
-        if self.opt['grouptags'][key] == child_key:
-          attr[key] = child_val
+        # collapse text content in element with no attributes to a string
+        if not len(attr) and pairs[-1][0] == '0' and val == pairs[-1][1]:
+          return { ctx.opt['contentkey'] : val } if 'forcecontent' in ctx.opt else val
+        key = ctx.opt['contentkey']
+      elif not val and 'suppressempty' in ctx.opt:
+        continue
+
+      self.merge(ctx, attr, key, val)
+
+    return self.finish(ctx, attr)
+
+  def collapse_attr(self, ctx, attr):
+    if 'noattr' in ctx.opt:
+      attr = {}
+    elif 'normalizespace' in ctx.opt and ctx.opt['normalizespace'] == 2:
+      for key, val in attr.items():
+        attr[key] = self.normalize_space(val)
+    return attr
+
+  def merge(self, ctx, attr, key, val):
+    # combine duplicate attributes
+    if attr.has_key(key):
+      if isinstance(attr[key], list):
+        attr[key].append(val)
+      else:
+        attr[key] = [attr[key], val]
+    elif val and isinstance(val, list):
+      attr[key] = [val]
+    else:
+      if 'contentkey' in ctx.opt and key != ctx.opt['contentkey'] and \
+            (ctx.opt['forcearray'] == 1 or \
+               (isinstance(ctx.opt['forcearray'], dict) and key in ctx.opt['forcearray'])):
+          attr[key] = [val]
+      else:
+        attr[key] = val
+
+  def finish(self, ctx, attr):
+    for key, val in attr.items():
+      attr[key] = self.finish_value(ctx, key, val)
 
     # fold hashes containing a single anonymous array up into just the array
     count = len(attr)
@@ -218,49 +804,106 @@ class xml2obj(ContentHandler):
       return attr['anon']
 
     # do the right thing if hash is empty otherwise just return it
-    if not len(attr) and self.opt.has_key('suppressempty'):
-      if self.opt['suppressempty'] == '':
+    if not len(attr) and ctx.opt.has_key('suppressempty'):
+      if ctx.opt['suppressempty'] == '':
         return ''
       return None
 
-    # roll up named elements with named nested 'value' attributes
-    if self.opt.has_key('valueattr'):
-      for key, val in attr.items():
-        if not self.opt['valueattr'].has_key(key):
-          continue
-        if not (isinstance(val, dict) and len(val) == 1):
-          continue
-        k = val.keys()[0]
-        if not k == self.opt['valueattr'][key]:
-          continue
-        attr[key] = val[key]
-
     return attr
 
+  def finish_value(self, ctx, key, val):
+    # what finish does to each value, which depends on nothing but the
+    # key and the value itself
+    folded = False
+
+    # turn array into hash if key fields present
+    if ctx.opt.has_key('keyattr') and val and isinstance(val, list):
+      if ctx.counts is None:
+        val = self.array_to_hash(ctx, key, val)
+      else:
+        val = self.counted_array_to_hash(ctx, key, val)
+      folded = isinstance(val, dict)
+
+    # disintermediate grouped tags
+    if ctx.opt.has_key('grouptags') and isinstance(val, dict) and len(val) == 1 \
+          and ctx.opt['grouptags'].has_key(key):
+      child_key, child_val = val.popitem()
+      if ctx.opt['grouptags'][key] == child_key:
+        val = child_val
+
+    # roll up named elements with named nested 'value' attributes
+    if ctx.opt.has_key('valueattr') and ctx.opt['valueattr'].has_key(key) \
+          and isinstance(val, dict) and len(val) == 1:
+      k = val.keys()[0]
+      if k == ctx.opt['valueattr'][key]:
+        val = val[k]
+
+    # children are not touched any more once their parent is finished,
+    # so leaf hashes among them can be turned into records now
+    if 'records' in ctx.opt:
+      if isinstance(val, dict):
+        if folded:
+          for k, v in val.items():
+            val[k] = self.make_record(ctx, key, v)
+        else:
+          val = self.make_record(ctx, key, val)
+      elif isinstance(val, list):
+        val = [self.make_record(ctx, key, v) for v in val]
+
+    return val
+
+  def make_record(self, ctx, name, val):
+    # the first leaf hash of an element fixes its shape, later ones with
+    # the same keys become records of it and others are left as hashes
+    if val.__class__ is not dict:
+      return val
+    for v in val.itervalues():
+      if not isinstance(v, basestring):
+        return val
+    cls = ctx.shapes.get(name)
+    if cls is None:
+      cls = ctx.shapes[name] = record_class(tuple(val))
+    elif len(val) != len(cls._fields) or not cls._keyset.issuperset(val):
+      return val
+    return cls.from_dict(val)
 
   def normalize_space(self, text):
-    text = re.sub('\s\s+', ' ', text.strip())
+    text = SpacesPattern.sub(' ', text.strip())
     return text
 
   # helper routine for collapse
   # attempt to 'fold' an array of hashes into an hash
-  def array_to_hash(self, name, array):
+  def counted_array_to_hash(self, ctx, name, array):
+    start = time.time()
+    hash = self.array_to_hash(ctx, name, array)
+    ctx.counts['time_fold'] += time.time() - start
+    if isinstance(hash, dict):
+      ctx.counts['folds'] += 1
+    return hash
+
+  def fallback(self, ctx, message):
+    # keyattr could not fold an array, which is left as it is
+    if ctx.counts is not None:
+      ctx.counts['fallbacks'] += 1
+    warnings.warn(message)
+
+  def array_to_hash(self, ctx, name, array):
     hash = {}
 
     # handle keyattr => {...}
-    if isinstance(self.opt['keyattr'], dict):
-      if not name in self.opt['keyattr']:
+    if isinstance(ctx.opt['keyattr'], dict):
+      if not name in ctx.opt['keyattr']:
         return array
-      (key, flag) = self.opt['keyattr'][name]
+      (key, flag) = ctx.opt['keyattr'][name]
       for item in array:
         if isinstance(item, dict) and key in item:
           val = item[key]
-          if isinstance(val, list) or isinstance(val, dict):
+          if isinstance(val, (list, dict, Record)):
             if StrictMode:
               raise ValueError("<%s> element has non-scalar '%s' key attribute" % (name, key))
-            warnings.warn("Warning: <%s> element has non-scalar '%s' key attribute" % (name, key))
+            self.fallback(ctx, "Warning: <%s> element has non-scalar '%s' key attribute" % (name, key))
             return array
-          if self.opt['normalizespace'] == 1:
+          if ctx.opt['normalizespace'] == 1:
             val = self.normalize_space(val)
           hash[val] = item
           if flag == '-':
@@ -270,7 +913,7 @@ class xml2obj(ContentHandler):
         else:
           if StrictMode:
             raise ValueError('<%s> element has no %s key attribute' % (name, key))
-          warnings.warn("Warning: <%s> element has no '%s' key attribute" % (name, key))
+          self.fallback(ctx, "Warning: <%s> element has no '%s' key attribute" % (name, key))
           return array
     # or assume keyattr => [...]
     else:
@@ -278,12 +921,12 @@ class xml2obj(ContentHandler):
         next = False
         if not isinstance(item, dict):
           return array
-        for key in self.opt['keyattr']:
+        for key in ctx.opt['keyattr']:
           if key in item:
             val = item[key]
-            if isinstance(val, dict) or isinstance(val, list):
+            if isinstance(val, (dict, list, Record)):
               return array
-            if 'normalizespace' in self.opt and self.opt['normalizespace'] == 1:
+            if 'normalizespace' in ctx.opt and ctx.opt['normalizespace'] == 1:
               val = self.normalize_space(val)
             hash[val] = item
             del hash[val][key]
@@ -294,13 +937,13 @@ class xml2obj(ContentHandler):
         return array
 
     # collapse any hashes which now only have a content key
-    if 'collapseagain' in self.opt:
-      hash = self.collapse_content(hash)
+    if 'collapseagain' in ctx.opt:
+      hash = self.collapse_content(ctx, hash)
 
     return hash
 
-  def collapse_content(self, hash):
-    contentkey = self.opt['contentkey']
+  def collapse_content(self, ctx, hash):
+    contentkey = ctx.opt['contentkey']
 
     # first go through the values, checking that they are fit to collapse
     for val in hash.values():
@@ -314,21 +957,81 @@ class xml2obj(ContentHandler):
     return hash
 
 
-  def XMLout(self, tree, options={}):
-    self.handle_options('out', options)
+  def XMLout(self, tree, options={}, file=None):
+    ctx = self.context('out', options)
+    return self.build_xml(ctx, tree, file)
+
+  def build_xml(self, ctx, tree, file=None):
+    parts = self.iter_parts(ctx, tree)
+    if 'stats' in ctx.opt:
+      parts = self.counted_parts(ctx, parts)
+    if file is None:
+      return ''.join(parts)
+    for chunk in self.iter_chunks(parts, DefBlockSize, 'utf-8'):
+      file.write(chunk)
+
+  def XMLout_iter(self, tree, options={}, chunk_size=None, encoding='utf-8'):
+    ctx = self.context('out', options)
+    if chunk_size is None:
+      chunk_size = DefBlockSize
+    parts = self.iter_parts(ctx, tree)
+    if 'stats' in ctx.opt:
+      parts = self.counted_parts(ctx, parts)
+    return self.iter_chunks(parts, chunk_size, encoding)
+
+  def counted_parts(self, ctx, parts):
+    # time spent making the pieces of xml, leaving out the time the
+    # consumer takes between them
+    ctx.counts = counts = dict.fromkeys(StatsOut, 0)
+    clock = time.time
+    elapsed = 0.0
+    parts = iter(parts)
+    while True:
+      start = clock()
+      try:
+        part = parts.next()
+      except StopIteration:
+        break
+      finally:
+        elapsed += clock() - start
+      counts['chars'] += len(part)
+      yield part
+    counts['time_serialize'] = elapsed
+    self.report_stats(ctx, elapsed)
+
+  def iter_chunks(self, parts, chunk_size, encoding):
+    # gathers small pieces of xml into encoded chunks of chunk_size bytes
+    chunk = []
+    size = 0
+    for part in parts:
+      if isinstance(part, unicode):
+        part = part.encode(encoding)
+      chunk.append(part)
+      size += len(part)
+      if size >= chunk_size:
+        yield ''.join(chunk)
+        chunk = []
+        size = 0
+    if chunk:
+      yield ''.join(chunk)
+
+  def iter_parts(self, ctx, tree):
+    rootname = ctx.opt['rootname']
+    if isinstance(tree, Views):
+      tree = unview(tree)
 
     # wrap to level list in a hash
     if isinstance(tree, list):
       tree = {'anon' : tree}
 
     # extract rootname from top level if keeproot enabled
-    if 'keeproot' in self.opt and self.opt['keeproot']:
+    if 'keeproot' in ctx.opt and ctx.opt['keeproot']:
       keys = tree.keys()
       if len(tree) == 1:
         tree = tree[keys[0]]
-        self.opt['rootname'] = keys[0]
+        rootname = keys[0]
     # ensure there are no top level attributes
-    elif self.opt['rootname'] == '':
+    elif rootname == '':
       if isinstance(tree, dict):
         treesave = tree
         tree = {}
@@ -339,184 +1042,1092 @@ class xml2obj(ContentHandler):
             tree[key] = [treesave[key]]
 
     # encode the tree
-    self._ancestors = []
-    xml = self.value_to_xml(tree, self.opt['rootname'], '')
-    del self._ancestors
-    if 'xmldecl' in self.opt and self.opt['xmldecl']:
-      xml = self.opt['xmldecl'] + '\n' + xml
-    
-    return xml
-
-  def value_to_xml(self, tree, name, indent):
+    if 'xmldecl' in ctx.opt and ctx.opt['xmldecl']:
+      yield ctx.opt['xmldecl'] + '\n'
+    for part in self.iter_xml(ctx, tree, rootname, 0):
+      yield part
+
+  def value_to_xml(self, ctx, tree, name, indent):
+    return ''.join(self.iter_xml(ctx, tree, name, len(indent) / 2))
+
+  def iter_xml(self, ctx, tree, name, depth):
+    # walk the tree without recursion, keeping a stack of the parts
+    # generators of the values being written
+    ctx.ancestors = set()
+    ctx.indents = ['']
+    stack = [self.xml_parts(ctx, tree, name, depth)]
+    while stack:
+      for part in stack[-1]:
+        if part.__class__ is subtree:
+          stack.append(self.xml_parts(ctx, *part))
+          break
+        yield part
+      else:
+        stack.pop()
+    del ctx.ancestors
+    del ctx.indents
+
+  def indent(self, ctx, depth):
+    indents = ctx.indents
+    while len(indents) <= depth:
+      indents.append(indents[-1] + '  ')
+    return indents[depth]
+
+  def xml_parts(self, ctx, tree, name, depth, extra=None):
+    # yields the xml of a value piece by piece. a nested value is
+    # yielded as a subtree, which is written in its place. extra is the
+    # (key attribute, key) of a hash unfolded by keyattr, written with
+    # the keys of tree as if it was one of them
     named = len(name) and 1 or 0
     nl = '\n'
-    is_root = len(indent) == 0 and 1 or 0
-    if 'noindent' in self.opt and self.opt['noindent']:
+    is_root = depth == 0 and 1 or 0
+    indent = self.indent(ctx, depth)
+    if 'noindent' in ctx.opt and ctx.opt['noindent']:
       indent = nl = ''
+    if isinstance(tree, Views):
+      tree = unview(tree)
 
     # convert to xml
     if isinstance(tree, list) or isinstance(tree, dict):
-      if len([elem for elem in self._ancestors if elem == tree]):
+      # ancestors are identified by id, an equal subtree is not a cycle
+      tree_id = id(tree)
+      if tree_id in ctx.ancestors:
         raise ValueError("circular data structures not supported")
-      self._ancestors.append(tree)
+      ctx.ancestors.add(tree_id)
     else:
       if named:
-        content = tree if 'noescape' in self.opt else self.escape_value(tree)
-        line = '%(indent)s<%(name)s>%(content)s</%(name)s>%(nl)s' % locals()
-        return line
+        content = tree if 'noescape' in ctx.opt else ctx.opt['escaper'].text(tree)
+        yield '%(indent)s<%(name)s>%(content)s</%(name)s>%(nl)s' % locals()
       else:
-        return str(tree) + nl
-
-    # unfold hash to array if possible
-    if isinstance(tree, dict) and len(tree) and self.opt['keyattr'] and not is_root:
-      tree = self.hash_to_array(name, tree)
-
-    result = []
+        yield str(tree) + nl
+      return
+
+    # unfold hash to array if possible, each value written as an element
+    # with its key in the key attribute, without copying the values
+    if extra is None and isinstance(tree, dict) and len(tree) and ctx.opt['keyattr'] \
+          and not is_root:
+      attr = self.unfold_attr(ctx, name, tree)
+      if attr is not None:
+        for key in tree:
+          yield subtree((tree[key], name, depth, (attr, key)))
+        ctx.ancestors.discard(tree_id)
+        return
 
     #handle hash
     if isinstance(tree, dict):
       # reintermediate grouped valued if applicable
-      if 'grouptags' in self.opt and self.opt['grouptags']:
-        tree = tree.copy() #self.copy_hash(tree)
+      if 'grouptags' in ctx.opt and ctx.opt['grouptags']:
+        tree = tree.copy() if extra is None else self.copy_hash(tree, extra)
+        extra = None
         for key, val in tree.items():
-          if key in self.opt['grouptags']:
-            tree[key] = { self.opt['grouptags'][key] : val }
+          if key in ctx.opt['grouptags']:
+            tree[key] = { ctx.opt['grouptags'][key] : val }
       
       nsdecls = ''
       default_ns_url = '';
+      start = []
       nested = []
       text_content = None
       if named:
-        result.extend([indent, '<', name, nsdecls])
-
-      if len(tree):
-        first_arg = 1
-        for key in self.sorted_keys(name, tree):
-          value = tree[key]
+        start.extend([indent, '<', name, nsdecls])
+
+      if len(tree) or extra is not None:
+        # options looked up once for all the keys
+        opt = ctx.opt
+        contentkey = opt['contentkey']
+        valueattr = opt.get('valueattr') or {}
+        noattr = 'noattr' in opt
+        noescape = 'noescape' in opt and opt['noescape']
+        escaper = opt['escaper']
+        attr, attr_value = extra or (None, None)
+        for key in self.sorted_keys(ctx, name, tree, attr):
+          if extra is not None and key == attr:
+            value = attr_value
+          else:
+            value = tree[key]
+          # most values are strings, which need no checks of their type
+          string = value.__class__ is str or value.__class__ is unicode
+          if not string and isinstance(value, Views):
+            value = unview(value)
           if not value:
             if key[0] == '-':
               continue
-            if key == self.opt['contentkey']:
+            if key == contentkey:
               text_content = ''
             else:
               value = ''
 
-          if not isinstance(value, dict) and not isinstance(value, list):
-            if 'valueattr' in self.opt and self.opt['valueattr']:
-              if key in self.opt['valueattr'] and self.opt['valueattr'][key]:
-                value = {self.opt['valueattr'][key] : value}
+          container = not string and isinstance(value, (dict, list))
+          if not container and key in valueattr and valueattr[key]:
+            value = {valueattr[key] : value}
+            container = True
 
-          if isinstance(value, dict) or isinstance(value, list) or 'noattr' in self.opt:
-            nested.append(self.value_to_xml(value, key, indent + '  '))
+          if container or noattr:
+            nested.append(subtree((value, key, depth + 1)))
+          elif key == contentkey:
+            text_content = value if noescape else escaper.text(value)
           else:
-            if not ('noescape' in self.opt and self.opt['noescape']):
-              value = self.escape_value(value)
-            if key == self.opt['contentkey']:
-              text_content = value
-            else:
-              result.extend([' ', key, '="', value, '"'])
-              first_arg = 0
+            if not noescape:
+              value = escaper.attr(value)
+            start.extend([' ', key, '="', value, '"'])
       else:
         text_content = ''
 
       if nested or text_content is not None:
         if named:
-          result.append('>')
+          start.append('>')
           if text_content is not None:
-            result.append(text_content)
-            if len(nested):
-              nested[0].lstrip()
+            start.append(text_content)
           else:
-            result.append(nl)
+            start.append(nl)
+          yield ''.join(start)
           if len(nested):
-            result.extend(nested)
-            result.append(indent)
-          result.extend(['</', name, '>', nl])
+            for child in nested:
+              yield child
+            yield indent
+          yield '</%s>%s' % (name, nl)
         else:
-          result.extend(nested)
+          if start:
+            yield ''.join(start)
+          for child in nested:
+            yield child
       else:
-        result.extend([' />', nl])
+        start.extend([' />', nl])
+        yield ''.join(start)
     # handle array
     elif isinstance(tree, list):
       for value in tree:
+        if isinstance(value, Views):
+          value = unview(value)
         if not isinstance(value, dict) and not isinstance(value, list):
-          result.extend([indent, '<', name, '>', value \
-                           if 'noescape' in self.opt and self.opt['noescape'] else self.escape_value(value),
+          yield ''.join([indent, '<', name, '>', value \
+                           if 'noescape' in ctx.opt and ctx.opt['noescape'] else ctx.opt['escaper'].text(value),
                          '</', name, '>' + nl])
         elif isinstance(value, dict):
-          result.append(self.value_to_xml(value, name, indent))
+          yield subtree((value, name, depth))
         else:
-          result.extend([indent, '<', name, '>' + nl,
-                         self.value_to_xml(value, 'anon', indent + '  '),
-                         indent, '</', name, '>' + nl])
+          yield ''.join([indent, '<', name, '>' + nl])
+          yield subtree((value, 'anon', depth + 1))
+          yield ''.join([indent, '</', name, '>' + nl])
     else:
       raise ValueError("Can't encode a value of type: " + tree.__class__)
 
-    if isinstance(tree, dict) or isinstance(tree, list):
-      self._ancestors.pop()
-
-    return ''.join(result)
-
-  def sorted_keys(self, name, tree):
-    hash = tree.copy()
-    keyattr = self.opt['keyattr']
-    key = []
-
-    if isinstance(tree, dict):
-      if name in keyattr and  keyattr[name][0] in hash:
-        key.append(keyattr[name][0])
-        del hash[keyattr[name][0]]
-    elif isinstance(tree, list):
-      for item in keyattr:
-        if item in hash:
-          key.append(item)
-          del hash[item]
-          break
+    ctx.ancestors.discard(tree_id)
 
-    if len(hash) > 0:
-      tmp = hash.keys()
-      tmp.sort()
-      key.extend(tmp)
-    return key
+  def sorted_keys(self, ctx, name, tree, extra=None):
+    return ctx.opt['keyorder'].keys(name, tree, extra)
 
   def escape_value(self, data):
-    if data is None:
-      return ''
-    data = str(data)
-    data = data.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
-    return data
-
-  def hash_to_array(self, parent, hash):
-    array = []
-    for key in hash:
-      value = hash[key]
-      if not isinstance(value, dict):
-        return hash
-      if isinstance(self.opt['keyattr'], dict):
-        if not parent in self.opt['keyattr']:
-          return hash
-        array.append(self.copy_hash(value, [self.opt['keyattr'][parent][0], key]))
-      else:
-        array.append(self.copy_hash(value, [self.opt['keyattr'][0], key]))
-    return array
+    return escape_attr(data)
+
+  def unfold_attr(self, ctx, parent, hash):
+    # the key attribute to unfold hash with, when all its values are
+    # hashes, or None
+    keyattr = ctx.opt['keyattr']
+    if isinstance(keyattr, dict):
+      if not parent in keyattr:
+        return None
+      attr = keyattr[parent][0]
+    else:
+      attr = keyattr[0]
+    for value in hash.itervalues():
+      if not isinstance(value, dict) and not isinstance(value, (Record, SharedDict)):
+        return None
+    return attr
 
   def copy_hash(self, orig, extra):
     result = orig.copy()
     result.update(dict(zip(extra[::2], extra[1::2])))
     return result
-      
+
+class Record(object):
+  # read-only mapping keeping its values in slots, made by XMLin with the
+  # records option for repeated elements of the same attributes. the
+  # classes are made by record_class, one for each tuple of keys
+  __slots__ = ()
+  _fields = ()
+  _slots = {}
+
+  @classmethod
+  def from_dict(cls, hash):
+    record = cls.__new__(cls)
+    for key, setter in cls._setters:
+      setter(record, hash[key])
+    return record
+
+  def __getitem__(self, key):
+    try:
+      slot = self._slots[key]
+    except (KeyError, TypeError):
+      raise KeyError(key)
+    return getattr(self, slot)
+
+  def __setattr__(self, key, value):
+    raise TypeError('records are read-only')
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def __contains__(self, key):
+    return key in self._keyset
+
+  has_key = __contains__
+
+  def __len__(self):
+    return len(self._fields)
+
+  def __iter__(self):
+    return iter(self._fields)
+
+  def keys(self):
+    return list(self._fields)
+
+  iterkeys = __iter__
+
+  def values(self):
+    return [self[key] for key in self._fields]
+
+  def itervalues(self):
+    for key in self._fields:
+      yield self[key]
+
+  def items(self):
+    return [(key, self[key]) for key in self._fields]
+
+  def iteritems(self):
+    for key in self._fields:
+      yield key, self[key]
+
+  def asdict(self):
+    return dict(self.iteritems())
+
+  copy = asdict
+
+  def __eq__(self, other):
+    if isinstance(other, Record):
+      other = other.asdict()
+    if not isinstance(other, dict):
+      return NotImplemented
+    return self.asdict() == other
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  __hash__ = None
+
+  def __repr__(self):
+    return repr(self.asdict())
+
+  def __reduce__(self):
+    return (make_record, (self._fields, tuple(self.values())))
+
+RecordClasses = {}
+
+class lazy_value(object):
+  # a value of a LazyDict not collapsed yet
+  __slots__ = ('obj', 'ctx', 'key', 'initial', 'parts')
+
+  def __init__(self, obj, ctx, key, initial, parts):
+    self.obj = obj
+    self.ctx = ctx
+    self.key = key
+    self.initial = initial
+    self.parts = parts
+
+  def collapse(self):
+    return self.obj.lazy_value(self.ctx, self.key, self.initial, self.parts)
+
+class LazyDict(dict):
+  # hash made by XMLin with the lazy option. its keys are known, but the
+  # value of an element is collapsed when it is first read and then kept.
+  # code reading the dict from C (like dict(hash) or json) may see the
+  # values not collapsed yet, so hand it materialize() instead
+
+  def __getitem__(self, key):
+    val = dict.__getitem__(self, key)
+    if val.__class__ is lazy_value:
+      val = val.collapse()
+      dict.__setitem__(self, key, val)
+    return val
+
+  def get(self, key, default=None):
+    if key in self:
+      return self[key]
+    return default
+
+  def values(self):
+    return [self[key] for key in self]
+
+  def itervalues(self):
+    for key in self.keys():
+      yield self[key]
+
+  def items(self):
+    return [(key, self[key]) for key in self]
+
+  def iteritems(self):
+    for key in self.keys():
+      yield key, self[key]
+
+  def pop(self, key, *default):
+    if key in self:
+      val = self[key]
+      dict.__delitem__(self, key)
+      return val
+    if default:
+      return default[0]
+    raise KeyError(key)
+
+  def popitem(self):
+    for key in self:
+      return key, self.pop(key)
+    raise KeyError('popitem(): dictionary is empty')
+
+  def setdefault(self, key, default=None):
+    if key in self:
+      return self[key]
+    self[key] = default
+    return default
+
+  def copy(self):
+    return dict(self.iteritems())
+
+  def materialize(self):
+    # the whole hash as plain dicts and lists, everything collapsed.
+    # materialize(tree) does the same for whatever XMLin returned
+    return dict([(key, materialize(val)) for key, val in self.iteritems()])
+
+  def __eq__(self, other):
+    if isinstance(other, LazyDict):
+      other = other.copy()
+    if not isinstance(other, dict):
+      return NotImplemented
+    return self.copy() == other
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  __hash__ = None
+
+  def __repr__(self):
+    return repr(self.copy())
+
+  def __reduce__(self):
+    return (dict, (), None, None, self.iteritems())
+
+def materialize(tree):
+  if isinstance(tree, (LazyDict, SharedDict, SharedList)):
+    return tree.materialize()
+  if isinstance(tree, dict):
+    for key, val in tree.items():
+      tree[key] = materialize(val)
+  elif isinstance(tree, list):
+    tree[:] = [materialize(val) for val in tree]
+  return tree
+
+def shared_path(name):
+  if os.sep in name or not os.path.isdir(SharedDir):
+    return name
+  return os.path.join(SharedDir, name)
+
+class shared_writer(object):
+  # encodes a tree for publish. each value is a tag byte and its data:
   #
-  # following methods overwrite ContentHandler
+  #   'u' / 's'   unicode (utf-8) / str : uint32 length, bytes
+  #   'd'         dict : uint32 count, count * (key, value) uint64 offsets
+  #               sorted by the bytes of the key, for binary search
+  #   'l'         list : uint32 count, count * uint64 offsets
+  #   'i' 'f'     int64, double
+  #   'n' 't' 'F' None, True, False
   #
-  
+  # values are written before what refers to them, the same strings and
+  # objects only once. the file starts with the magic and the offset of
+  # the root
+
+  def __init__(self, fp):
+    self.fp = fp
+    self.offset = 0
+    self.strings = {}
+    self.objects = {}
+    self.ancestors = set()
+
+  def write_tree(self, tree):
+    self.write(SharedMagic + struct.pack('<Q', 0))
+    root = self.encode(tree)
+    self.fp.seek(len(SharedMagic))
+    self.fp.write(struct.pack('<Q', root))
+
+  def write(self, data):
+    offset = self.offset
+    self.fp.write(data)
+    self.offset += len(data)
+    return offset
+
+  def encode(self, value):
+    cls = value.__class__
+    if cls is unicode or cls is str:
+      try:
+        return self.strings[cls, value]
+      except KeyError:
+        pass
+      data = value.encode('utf-8') if cls is unicode else value
+      offset = self.strings[cls, value] = self.write(
+        struct.pack('<cI', 'u' if cls is unicode else 's', len(data)) + data)
+      return offset
+    if value is None:
+      return self.write('n')
+    if cls is bool:
+      return self.write('t' if value else 'F')
+    if cls is int or cls is long:
+      return self.write(struct.pack('<cq', 'i', value))
+    if cls is float:
+      return self.write(struct.pack('<cd', 'f', value))
+
+    # objects are held with their offset, so the ids are not reused by
+    # the dicts and lists views turn into
+    key = id(value)
+    if key in self.objects:
+      return self.objects[key][0]
+    if key in self.ancestors:
+      raise ValueError('circular data structures not supported')
+    self.ancestors.add(key)
+    original = value
+    if isinstance(value, Views):
+      value = unview(value)
+    if isinstance(value, dict):
+      entries = []
+      for name, val in value.iteritems():
+        if not isinstance(name, basestring):
+          raise TypeError('keys of published trees must be strings, not %r' % (name,))
+        data = name.encode('utf-8') if isinstance(name, unicode) else name
+        entries.append((data, self.encode(name), self.encode(val)))
+      entries.sort()
+      data = [struct.pack('<cI', 'd', len(entries))]
+      data.extend([struct.pack('<QQ', name, val) for sortkey, name, val in entries])
+    elif isinstance(value, (list, tuple)):
+      offsets = [self.encode(val) for val in value]
+      data = [struct.pack('<cI', 'l', len(offsets)), struct.pack('<%dQ' % len(offsets), *offsets)]
+    else:
+      raise TypeError('%r can not be published' % (value,))
+    self.ancestors.discard(key)
+    offset = self.write(''.join(data))
+    self.objects[key] = (offset, original)
+    return offset
+
+def shared_value(mapped, offset):
+  tag = mapped[offset]
+  if tag == 'u' or tag == 's':
+    size = struct.unpack_from('<I', mapped, offset + 1)[0]
+    data = mapped[offset + 5:offset + 5 + size]
+    return data.decode('utf-8') if tag == 'u' else data
+  if tag == 'd':
+    return SharedDict(mapped, offset)
+  if tag == 'l':
+    return SharedList(mapped, offset)
+  if tag == 'i':
+    return struct.unpack_from('<q', mapped, offset + 1)[0]
+  if tag == 'f':
+    return struct.unpack_from('<d', mapped, offset + 1)[0]
+  if tag == 'n':
+    return None
+  return tag == 't'
+
+class SharedDict(object):
+  # read-only mapping over a dict written by publish, found by binary
+  # search on the keys. values are decoded each time they are read
+
+  __slots__ = ('mapped', 'offset', 'count')
+
+  def __init__(self, mapped, offset):
+    self.mapped = mapped
+    self.offset = offset
+    self.count = struct.unpack_from('<I', mapped, offset + 1)[0]
+
+  def entry(self, index):
+    return struct.unpack_from('<QQ', self.mapped, self.offset + 5 + 16 * index)
+
+  def key_data(self, offset):
+    size = struct.unpack_from('<I', self.mapped, offset + 1)[0]
+    return self.mapped[offset + 5:offset + 5 + size]
+
+  def find(self, key):
+    # offset of the value of key, or None
+    if isinstance(key, unicode):
+      key = key.encode('utf-8')
+    elif not isinstance(key, str):
+      return None
+    low, high = 0, self.count
+    while low < high:
+      middle = (low + high) // 2
+      key_offset, value_offset = self.entry(middle)
+      data = self.key_data(key_offset)
+      if data < key:
+        low = middle + 1
+      elif data > key:
+        high = middle
+      else:
+        return value_offset
+    return None
+
+  def __getitem__(self, key):
+    offset = self.find(key)
+    if offset is None:
+      raise KeyError(key)
+    return shared_value(self.mapped, offset)
+
+  def get(self, key, default=None):
+    offset = self.find(key)
+    if offset is None:
+      return default
+    return shared_value(self.mapped, offset)
+
+  def __contains__(self, key):
+    return self.find(key) is not None
+
+  has_key = __contains__
+
+  def __len__(self):
+    return self.count
+
+  def iterkeys(self):
+    for index in xrange(self.count):
+      yield shared_value(self.mapped, self.entry(index)[0])
+
+  __iter__ = iterkeys
+
+  def itervalues(self):
+    for index in xrange(self.count):
+      yield shared_value(self.mapped, self.entry(index)[1])
+
+  def iteritems(self):
+    for index in xrange(self.count):
+      key, value = self.entry(index)
+      yield shared_value(self.mapped, key), shared_value(self.mapped, value)
+
+  def keys(self):
+    return list(self.iterkeys())
+
+  def values(self):
+    return list(self.itervalues())
+
+  def items(self):
+    return list(self.iteritems())
+
+  def asdict(self):
+    return dict(self.iteritems())
+
+  copy = asdict
+
+  def materialize(self):
+    # the whole tree under this view as plain dicts and lists
+    return dict([(key, materialize(val)) for key, val in self.iteritems()])
+
+  def __eq__(self, other):
+    if isinstance(other, Views):
+      other = unview(other)
+    if not isinstance(other, dict):
+      return NotImplemented
+    return self.asdict() == other
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  __hash__ = None
+
+  def __repr__(self):
+    return repr(self.asdict())
+
+class SharedList(object):
+  # read-only sequence over a list written by publish
+
+  __slots__ = ('mapped', 'offset', 'count')
+
+  def __init__(self, mapped, offset):
+    self.mapped = mapped
+    self.offset = offset
+    self.count = struct.unpack_from('<I', mapped, offset + 1)[0]
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in xrange(*index.indices(self.count))]
+    if index < 0:
+      index += self.count
+    if not 0 <= index < self.count:
+      raise IndexError('list index out of range')
+    offset = struct.unpack_from('<Q', self.mapped, self.offset + 5 + 8 * index)[0]
+    return shared_value(self.mapped, offset)
+
+  def __len__(self):
+    return self.count
+
+  def __iter__(self):
+    for index in xrange(self.count):
+      yield self[index]
+
+  def __contains__(self, value):
+    for item in self:
+      if item == value:
+        return True
+    return False
+
+  def materialize(self):
+    return [materialize(val) for val in self]
+
+  def __eq__(self, other):
+    if isinstance(other, Views):
+      other = unview(other)
+    if not isinstance(other, list):
+      return NotImplemented
+    return list(self) == other
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  __hash__ = None
+
+  def __repr__(self):
+    return repr(list(self))
+
+# read-only views XMLout and publish turn into dicts and lists
+Views = (Record, SharedDict, SharedList)
+
+def unview(value):
+  if isinstance(value, SharedList):
+    return list(value)
+  return value.asdict()
+
+def record_class(fields):
+  # slots are named by position, as keys need not be identifiers. the
+  # classes are kept by key set, the fields in the order first seen, and
+  # forgotten when more than DefRecordClasses of them are made, so shapes
+  # seen once do not pile up in a long running process
+  keyset = frozenset(fields)
+  try:
+    return RecordClasses[keyset]
+  except KeyError:
+    if len(RecordClasses) >= DefRecordClasses:
+      RecordClasses.clear()
+    slots = tuple(['_%d' % i for i in range(len(fields))])
+    cls = type('record', (Record,), {
+      '__slots__' : slots,
+      '_fields'   : fields,
+      '_keyset'   : keyset,
+      '_slots'    : dict(zip(fields, slots)),
+      })
+    # slot descriptors are set directly, bypassing the read-only __setattr__
+    cls._setters = tuple([(key, cls.__dict__[slot].__set__)
+                          for key, slot in zip(fields, slots)])
+    return RecordClasses.setdefault(keyset, cls)
+
+def make_record(fields, values):
+  return record_class(fields).from_dict(dict(zip(fields, values)))
+
+class InternTable(object):
+  # shares equal element and attribute names, and attribute values up to
+  # maxlen characters when maxvalues is given, between the trees built.
+  # saved is the number of bytes which would have been allocated for
+  # the strings found in the table. a table may be shared by threads,
+  # each conversion adding what it saved when it is done
+  #
+  #   >>> table = InternTable(maxvalues=10000)
+  #   >>> tree = XMLin(xml, {'intern' : table})
+  #   >>> table.saved
+
+  def __init__(self, maxvalues=0, maxlen=DefInternLen):
+    self.names = {}
+    self.values = {}
+    self.maxvalues = maxvalues
+    self.maxlen = maxlen
+    self.saved = 0
+    self.lock = threading.Lock()
+
+  def name(self, name):
+    # the shared name, or None when name was not in the table (and is now)
+    shared = self.names.get(name)
+    if shared is None:
+      self.names.setdefault(name, name)
+    return shared
+
+  def value(self, value):
+    # the shared value, or None when value was not in the table
+    if len(value) > self.maxlen:
+      return None
+    shared = self.values.get(value)
+    if shared is None and len(self.values) < self.maxvalues:
+      self.values.setdefault(value, value)
+    return shared
+
+  def add_saved(self, saved):
+    with self.lock:
+      self.saved += saved
+
+class intern_filter(ContentHandler):
+  # passes sax events through, with names and values from the table.
+  # the bytes saved are counted here and added to the table at the end
+
+  def __init__(self, handler, table):
+    ContentHandler.__init__(self)
+    self.handler = handler
+    self.table = table
+    self.saved = 0
+    self.startDocument = handler.startDocument
+    self.characters = handler.characters
+    self.endElement = handler.endElement
+
+  def name(self, name):
+    shared = self.table.name(name)
+    if shared is None:
+      return name
+    self.saved += sys.getsizeof(shared)
+    return shared
+
+  def value(self, value):
+    shared = self.table.value(value)
+    if shared is None:
+      return value
+    self.saved += sys.getsizeof(shared)
+    return shared
+
+  def startElement(self, name, attrs):
+    attributes = {}
+    if self.table.maxvalues:
+      for key, val in attrs.items():
+        attributes[self.name(key)] = self.value(val)
+    else:
+      for key, val in attrs.items():
+        attributes[self.name(key)] = val
+    self.handler.startElement(self.name(name), attributes)
+
+  def endDocument(self):
+    self.table.add_saved(self.saved)
+    self.saved = 0
+    self.handler.endDocument()
+
+class MemoryCache(object):
+  # trees of the memshare and memcopy cache schemes. when there are more
+  # than maxentries of them or they take more than maxbytes, the least
+  # recently used ones are dropped. the size of a shared tree is taken
+  # as the size of its xml, of a copied one as the size of its pickle
+  #
+  #   >>> MemCache.maxentries = 1000
+  #   >>> MemCache.hits, MemCache.misses
+
+  def __init__(self, maxentries=DefCacheEntries, maxbytes=DefCacheBytes):
+    self.maxentries = maxentries
+    self.maxbytes = maxbytes
+    self.lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    self.entries = OrderedDict()
+    self.bytes = 0
+    self.hits = self.misses = self.evictions = 0
+
+  def get(self, key):
+    # raises KeyError when key is not in the cache
+    with self.lock:
+      try:
+        entry = self.entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        raise
+      self.entries[key] = entry
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value, size):
+    with self.lock:
+      if key in self.entries:
+        self.bytes -= self.entries.pop(key)[1]
+      if size > self.maxbytes:
+        return
+      self.entries[key] = (value, size)
+      self.bytes += size
+      while len(self.entries) > self.maxentries or self.bytes > self.maxbytes:
+        self.bytes -= self.entries.popitem(last=False)[1][1]
+        self.evictions += 1
+
+  def __len__(self):
+    return len(self.entries)
+
+MemCache = MemoryCache()
+
+class path_matcher(object):
+  # matches paths of elements from the root, like 'opt/item/option', as
+  # the parser goes down the document one element at a time. a name
+  # matches one element and may have wildcards as in fnmatch ('*'
+  # matches any element), '**' matches any number of elements
+  #
+  # the state of the walk is the set of (pattern, position) reached,
+  # and steps from a state with a name are remembered. up to cachesize
+  # of them are kept, when the cache is emptied
+
+  def __init__(self, patterns, cachesize=DefPathSteps):
+    if isinstance(patterns, basestring):
+      patterns = [patterns]
+    self.patterns = [[name for name in pattern.split('/') if name]
+                     for pattern in patterns]
+    self.start = self.closure([(i, 0) for i in range(len(self.patterns))])
+    self.cachesize = cachesize
+    self.steps = {}
+
+  def __repr__(self):
+    return 'path_matcher(%r)' % (['/'.join(pattern) for pattern in self.patterns],)
+
+  def closure(self, states):
+    # '**' may match no element at all
+    states = set(states)
+    for i, pos in list(states):
+      pattern = self.patterns[i]
+      while pos < len(pattern) and pattern[pos] == '**':
+        pos += 1
+        states.add((i, pos))
+    return frozenset(states)
+
+  def step(self, states, name):
+    # (states after the element called name, whether a pattern matched it)
+    try:
+      return self.steps[states, name]
+    except KeyError:
+      pass
+    if len(self.steps) >= self.cachesize:
+      self.steps.clear()
+    next = []
+    for i, pos in states:
+      pattern = self.patterns[i]
+      if pos == len(pattern):
+        continue
+      if pattern[pos] == '**':
+        next.append((i, pos))
+      elif fnmatch.fnmatchcase(name, pattern[pos]):
+        next.append((i, pos + 1))
+    next = self.closure(next)
+    matched = False
+    for i, pos in next:
+      if pos == len(self.patterns[i]):
+        matched = True
+        break
+    result = self.steps[states, name] = (next, matched)
+    return result
+
+class path_filter(ContentHandler):
+  # passes sax events through but for elements out of the paths to
+  # select and in the paths to skip, which are dropped with all their
+  # contents by counting the depth until their end. elements on the way
+  # to selected ones are kept with their attributes but not their text.
+  # the root is always kept
+
+  def __init__(self, handler, select=None, skip=None):
+    ContentHandler.__init__(self)
+    self.handler = handler
+    self.select = select
+    self.skip = skip
+    self.endDocument = handler.endDocument
+
+  def startDocument(self):
+    # selected counts the depth in a selected element, and without
+    # select everything is in one
+    self.dropped = 0
+    self.selected = 0 if self.select else 1
+    self.stack = [(self.select and self.select.start, self.skip and self.skip.start)]
+    self.handler.startDocument()
+
+  def startElement(self, name, attrs):
+    if self.dropped:
+      self.dropped += 1
+      return
+    select_states, skip_states = self.stack[-1]
+    root = len(self.stack) == 1
+    if self.skip:
+      skip_states, matched = self.skip.step(skip_states, name)
+      if matched and not root:
+        self.dropped = 1
+        return
+    if self.selected:
+      self.selected += 1
+    else:
+      select_states, matched = self.select.step(select_states, name)
+      if matched:
+        self.selected = 1
+      elif not select_states and not root:
+        self.dropped = 1
+        return
+    self.stack.append((select_states, skip_states))
+    self.handler.startElement(name, attrs)
+
+  def characters(self, content):
+    if self.selected and not self.dropped:
+      self.handler.characters(content)
+
+  def endElement(self, name):
+    if self.dropped:
+      self.dropped -= 1
+      return
+    if self.selected:
+      self.selected -= 1
+    self.stack.pop()
+    self.handler.endElement(name)
+
+class stats_filter(ContentHandler):
+  # passes sax events through, counting elements, attributes and text.
+  # the end of the document is where the tree engine collapses the tree,
+  # the onepass and iter builders time their collapsing themselves
+
+  def __init__(self, handler, counts):
+    ContentHandler.__init__(self)
+    self.handler = handler
+    self.counts = counts
+    self.depth = 0
+    self.startDocument = handler.startDocument
+
+  def startElement(self, name, attrs):
+    counts = self.counts
+    counts['elements'] += 1
+    counts['attributes'] += len(attrs)
+    self.depth += 1
+    if self.depth > counts['max_depth']:
+      counts['max_depth'] = self.depth
+    self.handler.startElement(name, attrs)
+
+  def characters(self, content):
+    self.counts['text_chars'] += len(content)
+    self.handler.characters(content)
+
+  def endElement(self, name):
+    self.depth -= 1
+    self.handler.endElement(name)
+
+  def endDocument(self):
+    start = time.time()
+    self.handler.endDocument()
+    self.counts['time_collapse'] += time.time() - start
+
+class expat_reader(object):
+  # drives pyexpat without the sax layer. text is buffered by expat and
+  # attributes come as a dict built in C, handed to the handler as is
+
+  def __init__(self, handler):
+    self.handler = handler
+    self.parser = parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = DefBlockSize
+    parser.StartElementHandler = handler.startElement
+    parser.EndElementHandler = handler.endElement
+    parser.CharacterDataHandler = handler.characters
+    handler.startDocument()
+
+  def feed(self, data):
+    self.parser.Parse(data, False)
+
+  def close(self):
+    self.parser.Parse('', True)
+    self.handler.endDocument()
+
+class chunk_reader(object):
+  # file-like object over an iterable of chunks, for iterparse
+
+  def __init__(self, chunks):
+    self.chunks = iter(chunks)
+    self.count = 0
+
+  def read(self, size=-1):
+    for chunk in self.chunks:
+      if chunk:
+        self.count += 1
+        return chunk
+    return ''
+
+XmlNamespace = 'http://www.w3.org/XML/1998/namespace'
+
+def iterparse_qname(name, prefixes):
+  # etree's {uri}local back to the prefix:local of the document
+  if name[0] != '{':
+    return unicode(name)
+  uri, local = name[1:].split('}', 1)
+  prefix = prefixes.get(uri)
+  return unicode('%s:%s' % (prefix, local) if prefix else local)
+
+def iterparse_steps(content, handler):
+  # replays etree.iterparse events as sax events. text of an element is
+  # complete at the start of its first child or at its end, and tail of
+  # a child at the start of the next one or at the end of the parent.
+  # children are dropped as soon as their tail is handed out. etree gives
+  # ascii strings as str, turned to unicode as sax and expat give them.
+  # sax and expat see namespaces as plain names and xmlns attributes, so
+  # the prefixes declared in scope turn etree's names back into those
+  reader = chunk_reader(iter_source(content))
+  count = 0
+  stack = []
+  prefixes = {XmlNamespace : 'xml'}
+  declared = []
+  handler.startDocument()
+  for event, elem in etree.iterparse(reader, events=('start', 'end', 'start-ns')):
+    if event == 'start':
+      if stack:
+        frame = stack[-1]
+        parent, last = frame[:2]
+        text = parent.text if last is None else last.tail
+        if text:
+          handler.characters(unicode(text))
+        if last is not None:
+          del parent[0]
+        frame[1] = elem
+      attrib = elem.attrib
+      scope = None
+      if declared:
+        # prefixes of the parent, given back at the end of this element
+        scope = prefixes
+        prefixes = dict(prefixes)
+        attrib = dict(attrib)
+        for prefix, uri in declared:
+          prefixes[uri] = prefix
+          attrib['xmlns:' + prefix if prefix else 'xmlns'] = uri
+        declared = []
+      if attrib:
+        attrib = dict([(iterparse_qname(key, prefixes), unicode(val))
+                       for key, val in attrib.iteritems()])
+      handler.startElement(iterparse_qname(elem.tag, prefixes), attrib)
+      stack.append([elem, None, scope])
+    elif event == 'end':
+      elem, last, scope = stack.pop()
+      text = elem.text if last is None else last.tail
+      if text:
+        handler.characters(unicode(text))
+      del elem[:]
+      handler.endElement(iterparse_qname(elem.tag, prefixes))
+      if scope is not None:
+        prefixes = scope
+    else:
+      declared.append(elem)
+    if reader.count != count:
+      count = reader.count
+      yield
+  handler.endDocument()
+  yield
+
+class tree_builder(ContentHandler):
+  # builds the whole document as nested lists of [attributes, name,
+  # [...], '0', text, ...], collapsed at the end by the xml2obj
+
+  def __init__(self, obj, ctx):
+    ContentHandler.__init__(self)
+    self.obj = obj
+    self.ctx = ctx
+
   def startDocument(self):
     self.lists = []
     self.curlist = self.tree = []
 
   def startElement(self, name, attrs):
-    attributes = {}
-    for attr in attrs.items():
-      attributes[attr[0]] = attr[1]
+    # expat and iterparse give a dict of their own, sax its Attributes
+    attributes = attrs if attrs.__class__ is dict else dict(attrs.items())
     newlist = [attributes]
     self.curlist.extend([name, newlist])
     self.lists.append(self.curlist)
@@ -540,12 +2151,552 @@ class xml2obj(ContentHandler):
     tree = self.tree
     del self.tree
 
-    if 'keeproot' in self.opt:
-      tree = self.collapse({}, tree)
+    ctx = self.ctx
+    collapse = self.obj.lazy_collapse if ctx.opt.get('lazy') else self.obj.collapse
+    if 'keeproot' in ctx.opt:
+      tree = collapse(ctx, {}, tree)
     else:
-      tree = self.collapse(tree[1][0], tree[1][1:])
+      tree = collapse(ctx, tree[1][0], tree[1][1:])
     self.tree = tree
 
+class onepass_builder(ContentHandler):
+  # collapses each element in endElement, so the list tree is never built.
+  # each open element is kept as [attributes, name, pairs, text buffer]
+
+  def __init__(self, obj, ctx):
+    ContentHandler.__init__(self)
+    self.obj = obj
+    self.ctx = ctx
+
+  def startDocument(self):
+    self.stack = []
+    self.cur = [{}, None, [], []]
+
+  def startElement(self, name, attrs):
+    self.flush_text()
+    attributes = attrs if attrs.__class__ is dict else dict(attrs.items())
+    self.stack.append(self.cur)
+    self.cur = [attributes, name, [], []]
+
+  def characters(self, content):
+    self.cur[3].append(content)
+
+  def flush_text(self):
+    buf = self.cur[3]
+    if buf:
+      text = buf[0] if len(buf) == 1 else ''.join(buf)
+      del buf[:]
+      if not is_blank(text):
+        self.cur[2].append(('0', text))
+
+  def endElement(self, name):
+    self.flush_text()
+    attributes, name, pairs, buf = self.cur
+    if self.ctx.counts is None:
+      val = self.obj.fold(self.ctx, attributes, pairs)
+    else:
+      start = time.time()
+      val = self.obj.fold(self.ctx, attributes, pairs)
+      self.ctx.counts['time_collapse'] += time.time() - start
+    self.cur = self.stack.pop()
+    self.cur[2].append((name, val))
+
+  def endDocument(self):
+    pairs = self.cur[2]
+    del self.stack
+    del self.cur
+    if 'keeproot' in self.ctx.opt:
+      self.tree = self.obj.fold(self.ctx, {}, pairs)
+    else:
+      self.tree = pairs[0][1]
+
+class Converter(object):
+  # normalizes options once and reuses them for every conversion,
+  # for callers converting many documents with the same options
+  #
+  #   >>> conv = Converter({'keyattr' : ['id'], 'forcearray' : 1})
+  #   >>> tree = conv.loads(xml)
+  #   >>> xml  = conv.dumps(tree)
+
+  #
+  # each call runs in a context of its own, so a Converter may be shared
+  # by many threads converting at once
+
+  def __init__(self, options={}):
+    self.obj = xml2obj(options)
+    self.opt_in  = self.obj.normalize_options('in', {})
+    self.opt_out = self.obj.normalize_options('out', {})
+
+  def loads(self, content):
+    return self.obj.build_tree(context(self.opt_in), content)
+
+  def dumps(self, tree, file=None):
+    return self.obj.build_xml(context(self.opt_out), tree, file)
+
+class PushParser(object):
+  # incremental XMLin for callers given the xml piece by piece, like an
+  # event loop reading a socket. each feed parses just the data given and
+  # returns, so the loop is never blocked for longer than a piece takes.
+  # with path, the elements found at the path are returned by feed as
+  # soon as they are complete, like XMLiter
+  #
+  #   >>> parser = PushParser({'engine' : 'onepass'})
+  #   >>> for data in pieces:
+  #   ...   parser.feed(data)
+  #   >>> tree = parser.close()
+  #
+  # with the onepass engine the tree is collapsed while it is fed, so
+  # close has little left to do. for the other way round, XMLout_iter
+  # gives the xml in chunks to write one at a time, waiting for the
+  # transport to drain in between
+
+  def __init__(self, options={}, path=None):
+    if path is None:
+      self.obj = xml2obj(options)
+    else:
+      self.obj = xml2iter(path, options)
+    self.ctx = self.obj.context('in')
+    if self.ctx.opt.get('parser', DefParser) == 'iterparse':
+      raise ValueError("PushParser needs the 'sax' or 'expat' parser")
+    if 'cache' in self.ctx.opt:
+      raise ValueError("'Cache' option is not supported by PushParser")
+    self.path = path
+    self.pieces = []
+    self.closed = False
+    # the first error raised by the parser, after which the parser is
+    # dead and every feed or close raises ValueError
+    self.error = None
+    self.finished = False
+    self.handler = self.obj.make_handler(self.ctx)
+    self.steps = self.obj.parse_steps(self.ctx, self.iter_pieces(), self.handler)
+    self.elapsed = 0.0
+
+  def iter_pieces(self):
+    # parse_steps takes a piece at a time, and is resumed once per feed
+    while not self.closed:
+      yield self.pieces.pop()
+
+  def feed(self, data):
+    if self.closed:
+      raise ValueError('feed after close')
+    self.check_error()
+    start = time.time()
+    self.pieces.append(data)
+    try:
+      self.steps.next()
+    except StopIteration:
+      self.error = ValueError('parser stopped before the end of the document')
+      raise self.error
+    except Exception, e:
+      self.error = e
+      raise
+    self.elapsed += time.time() - start
+    return self.take_records()
+
+  def close(self):
+    # the tree, or with path the elements completed since the last feed
+    self.check_error()
+    start = time.time()
+    self.closed = True
+    if self.finished:
+      raise ValueError('close after close')
+    try:
+      for step in self.steps:
+        pass
+    except Exception, e:
+      self.error = e
+      raise
+    self.finished = True
+    if self.ctx.counts is not None:
+      self.obj.report_stats(self.ctx, self.elapsed + time.time() - start)
+    if self.path is None:
+      return self.handler.tree
+    return self.take_records()
+
+  def check_error(self):
+    if self.error is not None:
+      raise ValueError('parser failed earlier: %s: %s' %
+                       (self.error.__class__.__name__, self.error))
+
+  def take_records(self):
+    if self.path is None:
+      return []
+    records = self.handler.records[:]
+    del self.handler.records[:]
+    return records
+
+# Converter of the worker process, set once by init_worker
+WorkerConverter = None
+
+def init_worker(converter):
+  global WorkerConverter
+  WorkerConverter = converter
+
+def convert_batch(dirn, batch):
+  # (results, counters of each conversion with the stats option). the
+  # stats of the caller are in the parent, who is sent the counters
+  try:
+    obj = WorkerConverter.obj
+    opt = WorkerConverter.opt_in if dirn == 'in' else WorkerConverter.opt_out
+    counts = None
+    if 'stats' in opt:
+      counts = []
+      opt = dict(opt, stats=counts.append)
+    if dirn == 'in':
+      return [obj.build_tree(context(opt), content) for content in batch], counts
+    return [obj.build_xml(context(opt), tree) for tree in batch], counts
+  except Exception, e:
+    raise_picklable(e)
+
+# guards the dicts of the stats option, which threads converting with
+# the same options add up into at once
+StatsLock = threading.Lock()
+
+def add_stats(stats, counts):
+  # hand the counters of a conversion to the stats option, a callable
+  # taking them or a dict adding them up over conversions
+  if callable(stats):
+    stats(counts)
+    return
+  with StatsLock:
+    for key, val in counts.items():
+      if key == 'max_depth':
+        stats[key] = max(stats.get(key, 0), val)
+      else:
+        stats[key] = stats.get(key, 0) + val
+
+def raise_picklable(e):
+  # an exception which cannot be rebuilt in the parent (like
+  # SAXParseException) would hang the pool, so send a plain one
+  try:
+    cPickle.loads(cPickle.dumps(e, 2))
+  except Exception:
+    raise ValueError('%s: %s' % (e.__class__.__name__, e))
+  raise
+
+def iter_batches(items, chunksize):
+  batch = []
+  for item in items:
+    batch.append(item)
+    if len(batch) >= chunksize:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+def convert_many(dirn, items, options, workers, chunksize, ordered):
+  # options are normalized here and handed to each worker once, with the
+  # pool initializer. batches of chunksize items are sent as the results
+  # are taken, so only a couple of batches per worker are ever in flight
+  # and neither the input nor the output is held as a whole
+  converter = Converter(options)
+  stats = (converter.opt_in if dirn == 'in' else converter.opt_out).get('stats')
+  workers = workers or multiprocessing.cpu_count()
+  pool = multiprocessing.Pool(workers, init_worker, (converter,))
+  try:
+    batches = iter_batches(items, max(chunksize, 1))
+    pending = deque()
+    while True:
+      while len(pending) < workers * 2:
+        try:
+          batch = batches.next()
+        except StopIteration:
+          break
+        pending.append(pool.apply_async(convert_batch, (dirn, batch)))
+      if not pending:
+        break
+      if ordered:
+        done = pending.popleft()
+      else:
+        while True:
+          for done in pending:
+            if done.ready():
+              break
+          else:
+            pending[0].wait(0.01)
+            continue
+          break
+        pending.remove(done)
+      results, counts = done.get()
+      for one in counts or ():
+        add_stats(stats, one)
+      for result in results:
+        yield result
+  finally:
+    # all the work is done, or the caller gave up on the results
+    pool.terminate()
+    pool.join()
+
+class xml2iter(xml2obj):
+  # builds only the subtrees of elements found at the given path
+  # and hands them out as soon as they are collapsed
+
+  def __init__(self, path, options={}):
+    xml2obj.__init__(self, options)
+    self.path = [name for name in path.split('/') if name]
+
+  def XMLiter(self, content, options={}):
+    ctx = self.context('in', options)
+    handler = self.make_handler(ctx)
+    start = time.time()
+    for step in self.parse_steps(ctx, content, handler):
+      for record in handler.records:
+        yield record
+      del handler.records[:]
+    if ctx.counts is not None:
+      self.report_stats(ctx, time.time() - start)
+
+  def make_handler(self, ctx):
+    # each record is built as a small tree and collapsed once closed,
+    # which is what both engines come to for a single element. lazy
+    # records would keep the raw tree of every record, so they are refused
+    if ctx.opt.get('lazy'):
+      raise ValueError("'Lazy' option is not supported by XMLiter")
+    if 'cache' in ctx.opt:
+      raise ValueError("'Cache' option is not supported by XMLiter")
+    if ctx.opt.get('engine', DefEngine) not in ('tree', 'onepass'):
+      raise ValueError("Illegal value for 'Engine' option - expected 'tree' or 'onepass'")
+    return iter_builder(self, ctx, self.path)
+
+class iter_builder(tree_builder):
+  # a tree_builder for the elements at path only, each collapsed into
+  # records as soon as it is closed
+
+  def __init__(self, obj, ctx, path):
+    tree_builder.__init__(self, obj, ctx)
+    self.path = path
+
+  def startDocument(self):
+    self.names = []
+    self.records = []
+    self.lists = []
+    self.curlist = None
+
+  def startElement(self, name, attrs):
+    self.names.append(name)
+    if self.curlist is None:
+      if len(self.names) != len(self.path) or self.names != self.path:
+        return
+      self.curlist = self.tree = []
+    tree_builder.startElement(self, name, attrs)
+
+  def characters(self, content):
+    if self.curlist is not None:
+      tree_builder.characters(self, content)
+
+  def endElement(self, name):
+    self.names.pop()
+    if self.curlist is None:
+      return
+    tree_builder.endElement(self, name)
+    if not self.lists:
+      # the record is complete, collapse it and drop the raw tree
+      node = self.tree[1]
+      if self.ctx.counts is None:
+        self.records.append(self.obj.collapse(self.ctx, node[0], node[1:]))
+      else:
+        start = time.time()
+        self.records.append(self.obj.collapse(self.ctx, node[0], node[1:]))
+        self.ctx.counts['time_collapse'] += time.time() - start
+      self.curlist = self.tree = None
+
+  def endDocument(self):
+    del self.names
+    del self.lists
+    del self.curlist
+    del self.tree
+
+def read_range(content, start, end):
+  if '<' in content:
+    return content[start:end]
+  fp = open(content, 'rb')
+  try:
+    fp.seek(start)
+    return fp.read(end - start)
+  finally:
+    fp.close()
+
+def scan_slices(content, slicesize):
+  # find where the children of the root start with a quick expat pass,
+  # cutting the body of the root into slices of about slicesize bytes.
+  # returns the root name and attributes, the text up to the end of the
+  # root start tag, the root end tag and the offsets of the cuts
+  parser = expat.ParserCreate()
+  depth = [0]
+  root = []
+  cuts = []
+
+  def start(name, attrs):
+    if not depth[0]:
+      root.extend([name, attrs])
+      cuts.append(parser.CurrentByteIndex)
+    elif depth[0] == 1 and parser.CurrentByteIndex - cuts[-1] >= slicesize:
+      cuts.append(parser.CurrentByteIndex)
+    depth[0] += 1
+
+  def end(name):
+    depth[0] -= 1
+    if not depth[0]:
+      cuts.append(parser.CurrentByteIndex)
+
+  parser.StartElementHandler = start
+  parser.EndElementHandler = end
+  for chunk in iter_source(content):
+    parser.Parse(chunk, False)
+  parser.Parse('', True)
+
+  # the start tag itself is left to the workers, who need it as it is
+  size = 4096
+  while True:
+    tag = read_range(content, cuts[0], cuts[0] + size)
+    m = StartTagPattern.match(tag)
+    if m or len(tag) < size:
+      break
+    size *= 2
+  if not m or tag[m.end() - 2] == '/':
+    return None
+  cuts[0] += m.end()
+  head = read_range(content, 0, cuts[0])
+  tail = '</%s>' % m.group(1)
+  # a short last slice is not worth a task of its own
+  if len(cuts) > 2 and cuts[-1] - cuts[-2] < slicesize / 2:
+    del cuts[-2]
+  return root[0], root[1], head, tail, cuts
+
+# (xml2obj, options, content, head, tail) of the worker process, set by
+# init_slicer
+SliceWorker = None
+
+def init_slicer(opt, content, head, tail):
+  global SliceWorker
+  SliceWorker = (xml2obj(), opt, content, head, tail)
+
+def parse_slice(task):
+  # (pairs, counters, record shapes learnt) of the slice between the
+  # offsets cut. shapes, as fields by element name, are set in advance
+  # when the parent has decided them
+  obj, opt, content, head, tail = SliceWorker
+  cut, shapes = task
+  try:
+    ctx = context(opt)
+    if shapes:
+      for name, fields in shapes.items():
+        ctx.shapes[name] = record_class(fields)
+    handler = slice_builder(obj, ctx)
+    xml = head + read_range(content, cut[0], cut[1]) + tail
+    for step in obj.parse_steps(ctx, xml, handler):
+      pass
+    shapes = dict([(name, cls._fields) for name, cls in ctx.shapes.items()])
+    return handler.pairs, ctx.counts, shapes
+  except Exception, e:
+    raise_picklable(e)
+
+class slice_builder(onepass_builder):
+  # collapses everything in a slice of the document but the root, whose
+  # (name, value) pairs are kept for the parent to fold
+
+  def endElement(self, name):
+    if len(self.stack) > 1:
+      onepass_builder.endElement(self, name)
+      return
+    self.flush_text()
+    self.pairs = self.cur[2]
+    self.cur = self.stack.pop()
+
+  def endDocument(self):
+    del self.stack
+    del self.cur
+
+class xml2slices(xml2obj):
+  # parses slices of the root body in worker processes and folds the
+  # collapsed children they send back into the root, in document order
+
+  def XMLin_parallel(self, content, workers=None, slicesize=DefSliceSize,
+                     options={}):
+    # with the stats option, the counters of the workers are added up
+    # into one report. the times of the workers overlap, so only the
+    # counts are kept from them: time_total is the time of the whole
+    # call and time_collapse that of folding the root
+    ctx = self.context('in', options)
+    if ctx.opt.get('lazy'):
+      raise ValueError("'Lazy' option is not supported by XMLin_parallel")
+    # slices are cut at children of the root the filter may drop, which
+    # would part the text around them, so filtered documents go serial
+    if 'select' in ctx.opt or 'skip' in ctx.opt:
+      return self.build_tree(ctx, content)
+    # unicode xml goes to the parsers encoded with the default encoding,
+    # here the slices are cut at byte offsets of the encoded string
+    if isinstance(content, unicode) and '<' in content:
+      content = str(content)
+    scan = None
+    if isinstance(content, basestring):
+      scan = scan_slices(content, slicesize)
+    if not scan or len(scan[4]) < 3:
+      return self.build_tree(ctx, content)
+    name, attrs, head, tail, cuts = scan
+
+    # content is inherited by the forked workers, not sent to them
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count(),
+                                init_slicer, (ctx.opt, content, head, tail))
+    start = time.time()
+    try:
+      slices = zip(cuts, cuts[1:])
+      parts = pool.map(parse_slice, [(cut, None) for cut in slices])
+      if 'records' in ctx.opt:
+        parts = self.share_shapes(ctx, pool, slices, parts)
+    finally:
+      pool.terminate()
+      pool.join()
+    pairs = []
+    for part, counts, shapes in parts:
+      pairs.extend(part)
+      if counts is not None:
+        self.add_slice_counts(ctx, counts)
+
+    if ctx.counts is not None:
+      # every slice counted the root, which is there once
+      ctx.counts['elements'] -= len(slices) - 1
+      ctx.counts['attributes'] -= (len(slices) - 1) * len(attrs)
+    collapse = time.time()
+    tree = self.fold(ctx, attrs, pairs)
+    if 'keeproot' in ctx.opt:
+      tree = self.fold(ctx, {}, [(name, tree)])
+    if ctx.counts is not None:
+      ctx.counts['time_collapse'] += time.time() - collapse
+      self.report_stats(ctx, time.time() - start)
+    return tree
+
+  def share_shapes(self, ctx, pool, slices, parts):
+    # records are made as their parent is folded, in the workers for all
+    # but the children of the root, then here. so the shape serial XMLin
+    # would give an element is the first one of the slices, in order.
+    # slices which learnt another shape for an element are parsed again
+    # with the shapes set, and the root is folded with them too
+    shapes = {}
+    for part, counts, learnt in parts:
+      for name, fields in learnt.items():
+        shapes.setdefault(name, fields)
+    redo = [i for i, (part, counts, learnt) in enumerate(parts)
+            if [name for name, fields in learnt.items()
+                if frozenset(fields) != frozenset(shapes[name])]]
+    if redo:
+      again = pool.map(parse_slice, [(slices[i], shapes) for i in redo])
+      parts = list(parts)
+      for i, part in zip(redo, again):
+        parts[i] = part
+    for name, fields in shapes.items():
+      ctx.shapes[name] = record_class(fields)
+    return parts
+
+  def add_slice_counts(self, ctx, counts):
+    if ctx.counts is None:
+      ctx.counts = dict.fromkeys(StatsIn, 0)
+    for key, val in counts.items():
+      if key == 'max_depth':
+        ctx.counts[key] = max(ctx.counts[key], val)
+      elif not key.startswith('time_'):
+        ctx.counts[key] += val
+
 if __name__ == '__main__':
 #   opt = XMLin('''
 #     <opt> 
@@ -1,8 +1,61 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import copy
+import cPickle
+import os
+import shutil
+import tempfile
+import threading
 import unittest
-from pyxml2obj import XMLin
+import warnings
+from StringIO import StringIO
+from pyxml2obj import XMLin, XMLout, MemCache, XMLin_file, iter_mapped, XMLiter, PushParser, XMLin_many, XMLin_parallel, InternTable, Record, \
+     LazyDict, materialize, publish, attach, Converter, make_record, record_class, RecordClasses, \
+     DefRecordClasses, DefPathSteps
+
+Documents = [
+  '<opt name1="value1" name2="value2" />',
+  '<opt><name1>value1</name1><name1>value2</name1><name2> x </name2></opt>',
+  '<opt><x>a<y/>a</x><z>a<y/>b</z><w a="1">  text  </w></opt>',
+  '<opt>  <item attr="value">text</item>  tail <item>more</item></opt>',
+  '''
+  <opt>
+    <car license="SH6673" make="Ford" id="1">
+      <option key="1" pn="6389733317-12" desc="Electric Windows"/>
+      <option key="2" pn="3735498158-01" desc="Leather Seats"/>
+    </car>
+    <car license="LW1804" make="GM"   id="2">
+      <option key="1" pn="9926543-1167" desc="Steering Wheel"/>
+    </car>
+  </opt>
+  ''',
+  '''
+  <opt>
+    <anon>1</anon>
+    <anon><anon>2.1</anon><anon><anon>2.2.1</anon><anon>2.2.2</anon></anon></anon>
+  </opt>
+  ''',
+  '<opt><dirs><dir>/usr/bin</dir><dir>/usr/local/bin</dir></dirs></opt>',
+  '<opt><one value="1" /><two>2</two></opt>',
+  ]
+OptionSets = [
+  {},
+  {'keeproot' : 1},
+  {'forcearray' : 1, 'keyattr' : {'car' : 'license', 'option' : 'pn'}},
+  {'forcearray' : ['name1'], 'contentkey' : '-content'},
+  {'forcecontent' : 1, 'noattr' : 1},
+  {'grouptags' : {'dirs' : 'dir'}, 'normalizespace' : 2},
+  {'keyattr' : []},
+  ]
+
+def types(tree):
+  # the tree with every string replaced by its type
+  if isinstance(tree, dict):
+    return dict([(types(key), types(val)) for key, val in tree.items()])
+  if isinstance(tree, list):
+    return [types(val) for val in tree]
+  return type(tree)
 
 class Xml2objInTest(unittest.TestCase):
 
@@ -313,6 +366,11 @@ class Xml2objInTest(unittest.TestCase):
       'attr'    : 'value',
       'content' : 'text content'})
 
+  def testValueAttr(self):
+    xml = '<opt two="2"><one value="1" /><six num="6" /></opt>'
+    opt = XMLin(xml, {'valueattr' : { 'one' : 'value', 'six' : 'num' }})
+    self.assertEqual(opt, {'one' : '1', 'two' : '2', 'six' : '6'})
+
   def test_forcearray(self):
     xml = '''
     <opt zero="0">
@@ -344,5 +402,599 @@ class Xml2objInTest(unittest.TestCase):
     opt = XMLin(xml)
     self.assertEqual(opt, target)
     
+  def testSource(self):
+    xml = '''
+    <opt>
+      <name1>バリュー１</name1>
+      <name2>value2</name2>
+    </opt>
+    '''
+    target = {
+      'name1': u'バリュー１',
+      'name2': u'value2'
+      }
+
+    # open file
+    self.assertEqual(XMLin(StringIO(xml)), target)
+
+    # file path
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    try:
+      os.write(fd, xml)
+      os.close(fd)
+      self.assertEqual(XMLin(path), target)
+
+      # mapped in memory, also in slices splitting multibyte characters
+      for parser in ('sax', 'expat', 'iterparse'):
+        self.assertEqual(XMLin_file(path, {'parser' : parser}), target)
+        self.assertEqual(XMLin(iter_mapped(path, 5), {'parser' : parser}), target)
+      self.assertEqual(XMLin_file(path, mmap=False), target)
+    finally:
+      os.remove(path)
+
+    # iterable of byte chunks, splitting multibyte characters
+    chunks = [xml[i:i+3] for i in range(0, len(xml), 3)]
+    self.assertEqual(XMLin(iter(chunks)), target)
+
+  def testIter(self):
+    xml = '''
+    <opt>
+      <item name="item1" attr1="value1"><option key="1" pn="a" /></item>
+      <item name="item2" attr1="value2"><option key="2" pn="b" /></item>
+      <other>skipped</other>
+      <item name="item3">text</item>
+    </opt>
+    '''
+    target = [
+      { 'name' : 'item1', 'attr1' : 'value1', 'option' : { 'key' : '1', 'pn' : 'a' }},
+      { 'name' : 'item2', 'attr1' : 'value2', 'option' : { 'key' : '2', 'pn' : 'b' }},
+      { 'name' : 'item3', 'content' : 'text' },
+      ]
+    self.assertEqual(list(XMLiter(xml, 'opt/item')), target)
+
+    # folding rules apply inside of each record
+    opt = list(XMLiter(xml, 'opt/item', {'keyattr' : {'option' : 'pn'},
+                                         'forcearray' : ['option']}))
+    self.assertEqual(opt[0]['option'], { 'a' : { 'key' : '1' }})
+
+    # records are handed out before the whole document is read
+    consumed = []
+    def chunks():
+      for i in range(0, len(xml), 16):
+        consumed.append(i)
+        yield xml[i:i+16]
+    records = XMLiter(chunks(), 'opt/item')
+    self.assertEqual(records.next(), target[0])
+    self.assertTrue(len(consumed) < len(range(0, len(xml), 16)))
+
+    # a string is fed in blocks as well, so the first records come out
+    # before the parser gets to the error at its end
+    big = '<opt>%s</bad>' % ''.join(['<item name="n%d" />' % i for i in range(20000)])
+    for parser in ('sax', 'expat', 'iterparse'):
+      records = XMLiter(big, 'opt/item', {'parser' : parser})
+      self.assertEqual(records.next(), {'name' : 'n0'})
+      self.assertRaises(Exception, list, records)
+
+    # both engines give the same records, lazy ones are refused
+    self.assertEqual(list(XMLiter(xml, 'opt/item', {'engine' : 'onepass'})), target)
+    self.assertRaises(ValueError, list, XMLiter(xml, 'opt/item', {'engine' : 'unknown'}))
+    self.assertRaises(ValueError, list, XMLiter(xml, 'opt/item', {'lazy' : 1}))
+    self.assertRaises(ValueError, PushParser, {'lazy' : 1}, 'opt/item')
+
+  def testOnepassEngine(self):
+    for xml in Documents:
+      for opt in OptionSets:
+        expected = XMLin(xml, copy.deepcopy(opt))
+        opt = copy.deepcopy(opt)
+        opt['engine'] = 'onepass'
+        self.assertEqual(XMLin(xml, opt), expected)
+
+    # text split over many chunks is put together
+    chunks = iter(['<opt><a>', 'fir', 'st', '</a> ', ' <b>x</b></opt>'])
+    self.assertEqual(XMLin(chunks, {'engine' : 'onepass'}), {'a' : 'first', 'b' : 'x'})
+
+    self.assertRaises(ValueError, XMLin, '<opt />', {'engine' : 'unknown'})
+
+  def testParser(self):
+    documents = Documents + [
+      '''<?xml version="1.0" encoding="utf-8"?>
+      <!-- comment -->
+      <opt a="&lt;&amp;&gt;"><?pi data?>
+        <name>バリュー<![CDATA[<raw>]]>&#x41;</name>
+        <item key="1">one</item><item key="2">two</item>
+      </opt>''',
+      '<opt xmlns:x="http://e/x" xmlns="http://e/d"><x:item x:a="1">t</x:item><item b="2"/></opt>',
+      '''<opt xmlns:x="http://e/x"><x:a xml:lang="en"><y:b xmlns:y="http://e/x" y:c="1" />
+      <x:b xmlns:x="http://e/y" x:c="2" /></x:a><x:d x:e="3" /></opt>''',
+      ]
+    for xml in documents:
+      for opt in OptionSets:
+        expected = XMLin(xml, copy.deepcopy(opt))
+        for parser in ('expat', 'iterparse'):
+          for engine in ('tree', 'onepass'):
+            popt = copy.deepcopy(opt)
+            popt['parser'] = parser
+            popt['engine'] = engine
+            self.assertEqual(XMLin(xml, popt), expected)
+            self.assertEqual(types(XMLin(xml, popt)), types(expected))
+            chunks = iter([xml[i:i+7] for i in range(0, len(xml), 7)])
+            self.assertEqual(XMLin(chunks, copy.deepcopy(popt)), expected)
+
+    xml = Documents[4]
+    expected = list(XMLiter(xml, 'opt/car/option'))
+    self.assertEqual(len(expected), 3)
+    for parser in ('expat', 'iterparse'):
+      self.assertEqual(list(XMLiter(xml, 'opt/car/option', {'parser' : parser})), expected)
+
+    self.assertRaises(ValueError, XMLin, '<opt />', {'parser' : 'unknown'})
+
+  def testIntern(self):
+    xml = '''
+    <opt>
+      <item lang="en" desc="a long description which is not shared">one</item>
+      <item lang="en" desc="a long description which is not shared">two</item>
+      <item lang="ja" desc="a long description which is not shared">three</item>
+    </opt>
+    '''
+    expected = XMLin(xml)
+    for parser in ('sax', 'expat', 'iterparse'):
+      self.assertEqual(XMLin(xml, {'intern' : 1, 'parser' : parser}), expected)
+
+      table = InternTable(maxvalues=10)
+      opt = XMLin(xml, {'intern' : table, 'parser' : parser})
+      self.assertEqual(opt, expected)
+      items = opt['item']
+      self.assertTrue(items[0].keys()[0] is items[1].keys()[0])
+      self.assertTrue(items[0]['lang'] is items[1]['lang'])
+      self.assertTrue(items[0]['desc'] is not items[1]['desc'])
+      self.assertTrue(table.saved > 0)
+
+      # the table keeps sharing over the next conversion
+      saved = table.saved
+      again = XMLin(xml, {'intern' : table, 'parser' : parser})
+      self.assertTrue(again['item'][0]['lang'] is items[0]['lang'])
+      self.assertTrue(table.saved > saved)
+
+    # with intern 1 each call has a table of its own, which a Converter
+    # does not keep growing
+    conv = Converter({'intern' : 1})
+    first = conv.loads(xml)['item']
+    self.assertTrue(first[0].keys()[0] is first[1].keys()[0])
+    for i in range(100):
+      conv.loads('<opt><name%d a%d="1" /></opt>' % (i, i))
+    second = conv.loads(xml)['item']
+    self.assertTrue(second[0].keys()[0] is not first[0].keys()[0])
+    self.assertTrue(conv.opt_in['intern'] is True)
+
+    # the parsers share the same strings, so they save the same
+    saved = []
+    for parser in ('sax', 'expat', 'iterparse'):
+      table = InternTable(maxvalues=10)
+      XMLin(xml, {'intern' : table, 'parser' : parser})
+      saved.append(table.saved)
+    self.assertEqual(saved, [saved[0]] * 3)
+
+  def testRecords(self):
+    xml = '''
+    <opt>
+      <server name="sahara" osname="solaris" osversion="2.6" />
+      <server name="gobi" osname="irix" osversion="6.5" />
+      <server name="kalahari" osname="linux" osversion="2.0.34" />
+      <user login="alice" uid="1001" />
+      <user login="bob" uid="1002" />
+      <user login="carol" uid="1003" shell="zsh" />
+    </opt>
+    '''
+    for engine in ('tree', 'onepass'):
+      expected = XMLin(xml, {'engine' : engine})
+      opt = XMLin(xml, {'engine' : engine, 'records' : 1})
+      self.assertEqual(opt, expected)
+      self.assertEqual(XMLout(opt), XMLout(expected))
+      self.assertEqual(cPickle.loads(cPickle.dumps(opt, 2)), expected)
+
+      # folded by keyattr, each server is a record of the same shape
+      sahara = opt['server']['sahara']
+      self.assertTrue(isinstance(sahara, Record))
+      self.assertTrue(type(sahara) is type(opt['server']['gobi']))
+      self.assertEqual(sahara['osname'], 'solaris')
+      self.assertEqual(sorted(sahara.items()),
+                       [('osname', 'solaris'), ('osversion', '2.6')])
+      self.assertRaises(KeyError, lambda: sahara['name'])
+      self.assertRaises(TypeError, setattr, sahara, 'osname', 'linux')
+
+      # a user with an extra attribute stays a hash
+      users = opt['user']
+      self.assertTrue(isinstance(users[0], Record))
+      self.assertTrue(isinstance(users[2], dict))
+
+    # a record is no key to fold by
+    xml = '<opt><item><name a="1" /></item><item><name a="2" /></item></opt>'
+    self.assertEqual(XMLin(xml, {'records' : 1}), XMLin(xml))
+
+    # one class for a key set in any order, and no more than a bounded
+    # number of classes kept
+    one = make_record(('a', 'b'), ('1', '2'))
+    two = make_record(('b', 'a'), ('3', '4'))
+    self.assertTrue(type(one) is type(two))
+    self.assertEqual(two, {'a' : '4', 'b' : '3'})
+    for i in range(DefRecordClasses + 10):
+      record_class(('key%d' % i,))
+    self.assertTrue(len(RecordClasses) <= DefRecordClasses)
+
+  def testMany(self):
+    docs = ['<opt><item name="n%d" value="%d" /></opt>' % (i, i) for i in range(20)]
+    expected = [XMLin(doc) for doc in docs]
+    self.assertEqual(list(XMLin_many(docs, workers=2, chunksize=3)), expected)
+    done = list(XMLin_many(docs, workers=2, chunksize=3, ordered=False))
+    self.assertEqual(sorted(done), sorted(expected))
+    self.assertRaises(ValueError, list, XMLin_many(docs + ['<opt>'], workers=2))
+
+    # the counters of the workers come back to the caller
+    stats = {}
+    list(XMLin_many(docs, {'stats' : stats}, workers=2, chunksize=3))
+    self.assertEqual(stats['calls'], 20)
+    self.assertEqual(stats['elements'], 40)
+    counts = []
+    list(XMLin_many(docs, {'stats' : counts.append}, workers=2, chunksize=3))
+    self.assertEqual(len(counts), 20)
+
+  def testParallel(self):
+    items = ''.join(['<item name="n%d"><value>%d</value></item>' % (i, i)
+                     for i in range(500)])
+    xml = '''<?xml version="1.0"?>
+    <!DOCTYPE opt [<!ENTITY e "entity">]>
+    <opt one="1" two="&gt;">text &e;<list>a</list>%s<list>b</list>last</opt>
+    ''' % items
+    for options in ({}, {'keeproot' : 1}, {'keyattr' : [], 'forcearray' : 1}):
+      expected = XMLin(xml, options)
+      self.assertEqual(XMLin_parallel(xml, options, workers=2, slicesize=1000), expected)
+
+    # records have the shapes serial XMLin gives them, whatever shapes
+    # come first in each slice
+    items = []
+    for i in range(200):
+      keys = ('a', 'b') if i % 7 else ('a',)
+      leaf = '<leaf %s />' % ' '.join(['%s="%d"' % (key, i) for key in (('x',) if i % 5 else ('x', 'y'))])
+      items.append('<item %s>%s</item>' % (' '.join(['%s="%d"' % (key, i) for key in keys]), leaf))
+    xml = '<opt>%s<item a="0" b="1" /></opt>' % ''.join(items)
+    options = {'records' : 1, 'keyattr' : []}
+    expected = XMLin(xml, options)
+    opt = XMLin_parallel(xml, options, workers=2, slicesize=300)
+    self.assertEqual(opt, expected)
+    for got, want in zip(opt['item'], expected['item']):
+      self.assertEqual(isinstance(got, Record), isinstance(want, Record))
+      if 'leaf' in want:
+        self.assertEqual(isinstance(got['leaf'], Record), isinstance(want['leaf'], Record))
+    self.assertTrue([item for item in opt['item'] if isinstance(item, Record)])
+    self.assertTrue([item for item in opt['item'] if not isinstance(item, Record)])
+
+    # text around a skipped child stays together
+    xml = '<opt>' + '<a>x</a>' * 20 + 'one<debug/>two' + '<a>y</a>' * 20 + '</opt>'
+    options = {'skip' : 'opt/debug'}
+    self.assertEqual(XMLin_parallel(xml, options, workers=2, slicesize=1), XMLin(xml, options))
+    self.assertEqual(XMLin(xml, options)['content'], u'onetwo')
+
+    # too small to be cut, parsed serially
+    self.assertEqual(XMLin_parallel('<opt><a>1</a></opt>'), XMLin('<opt><a>1</a></opt>'))
+
+    # unicode strings and paths are cut too, lazy trees are refused
+    self.assertEqual(XMLin_parallel(unicode(xml), {}, workers=2, slicesize=1000), XMLin(xml))
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    try:
+      os.write(fd, xml)
+      os.close(fd)
+      self.assertEqual(XMLin_parallel(unicode(path), {}, workers=2, slicesize=1000), XMLin(xml))
+    finally:
+      os.remove(path)
+    self.assertRaises(ValueError, XMLin_parallel, xml, {'lazy' : 1})
+
+  def testThreads(self):
+    # one converter shared by threads converting documents of different
+    # shapes at once, each call with a context of its own
+    counts = []
+    conv = Converter({'parser' : 'expat', 'records' : 1, 'keyattr' : {'item' : 'name'},
+                      'forcearray' : ['item'], 'stats' : counts.append})
+    docs = []
+    for i in range(8):
+      items = ''.join(['<item name="n%d" value="%d" size="%d" />' % (j, j, i)
+                       for j in range(i * 10 + 1)])
+      docs.append('<opt id="%d"><list>%s</list>%s</opt>' % (i, '</list><list>' * i, items))
+    expected = [(conv.loads(doc), conv.dumps(conv.loads(doc))) for doc in docs]
+    del counts[:]
+    errors = []
+
+    def convert(index):
+      try:
+        for n in range(50):
+          tree = conv.loads(docs[index])
+          self.assertEqual((tree, conv.dumps(tree)), expected[index])
+      except Exception, e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=convert, args=(i,)) for i in range(len(docs))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(errors, [])
+    self.assertEqual(len(counts), 50 * len(docs) * 2)
+    elements = sorted([i * 11 + 3 for i in range(len(docs))] * 50)
+    self.assertEqual(sorted([c['elements'] for c in counts if 'elements' in c]), elements)
+
+    # a stats dict shared by the threads adds up every call
+    stats = {}
+    conv = Converter({'stats' : stats})
+    threads = [threading.Thread(target=lambda: [conv.loads(docs[1]) for n in range(200)])
+               for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(stats['calls'], 1600)
+    self.assertEqual(stats['elements'], 1600 * 14)
+
+  def testStats(self):
+    xml = '''
+    <opt>
+      <item name="one"><value>1</value></item>
+      <item name="two"><value>2</value></item>
+      <list key="a" />
+      <list />
+    </opt>
+    '''
+    options = {'keyattr' : {'item' : 'name', 'list' : 'key'}, 'forcearray' : ['item', 'list']}
+    warnings.simplefilter('ignore')
+    for engine in ('tree', 'onepass'):
+      counts = []
+      opt = XMLin(xml, dict(options, engine=engine, stats=counts.append))
+      self.assertEqual(opt, XMLin(xml, options))
+      counts = counts[0]
+      self.assertEqual(counts['elements'], 7)
+      self.assertEqual(counts['attributes'], 3)
+      self.assertEqual(counts['max_depth'], 3)
+      self.assertEqual(counts['folds'], 1)
+      self.assertEqual(counts['fallbacks'], 1)
+      self.assertTrue(counts['time_total'] >= counts['time_parse'] >= 0)
+
+    # the engines collapsing as they go time that too
+    big = '<opt>%s</opt>' % ''.join(['<item name="n%d"><value>%d</value></item>' % (i, i)
+                                     for i in range(2000)])
+    for engine in ('tree', 'onepass'):
+      counts = []
+      XMLin(big, dict(options, engine=engine, stats=counts.append))
+      self.assertTrue(counts[0]['time_collapse'] > 0)
+    counts = []
+    list(XMLiter(big, 'opt/item', {'stats' : counts.append}))
+    self.assertTrue(counts[0]['time_collapse'] > 0)
+    counts = []
+    push = PushParser({'engine' : 'onepass', 'stats' : counts.append})
+    push.feed(big)
+    push.close()
+    self.assertTrue(counts[0]['time_collapse'] > 0)
+
+    # parallel workers send their counters back, and cache hits count
+    counts = []
+    XMLin_parallel(big, dict(options, stats=counts.append), workers=2, slicesize=1000)
+    self.assertEqual(len(counts), 1)
+    self.assertEqual(counts[0]['elements'], 4001)
+    self.assertEqual(counts[0]['attributes'], 2000)
+    self.assertEqual(counts[0]['max_depth'], 3)
+    self.assertEqual(counts[0]['folds'], 1)
+    counts = []
+    for i in range(2):
+      XMLin(big, {'cache' : 'memcopy', 'stats' : counts.append})
+    self.assertEqual([c['cache_hits'] for c in counts], [0, 1])
+    self.assertEqual([c['elements'] for c in counts], [4001, 0])
+
+    # a dict adds up the counters of many conversions
+    stats = {}
+    for i in range(3):
+      XMLout(XMLin(xml, dict(options, stats=stats)), {'stats' : stats})
+    self.assertEqual(stats['calls'], 6)
+    self.assertEqual(stats['elements'], 21)
+    self.assertEqual(stats['max_depth'], 3)
+    self.assertTrue(stats['chars'] > 0 and stats['time_serialize'] >= 0)
+    warnings.resetwarnings()
+
+  def testLazy(self):
+    for xml in Documents:
+      for options in OptionSets:
+        expected = XMLin(xml, options)
+        self.assertEqual(XMLin(xml, dict(options, lazy=1)), expected)
+        self.assertEqual(materialize(XMLin(xml, dict(options, lazy=1))), expected)
+
+    xml = '''
+    <opt>
+      <head><title>title</title></head>
+      <item name="one"><value>1</value></item>
+      <item name="two"><value>2</value></item>
+    </opt>
+    '''
+    opt = XMLin(xml, {'lazy' : 1})
+    self.assertTrue(isinstance(opt, LazyDict))
+    self.assertEqual(sorted(opt.keys()), ['head', 'item'])
+    # only what is read gets collapsed
+    self.assertEqual(opt['head']['title'], 'title')
+    self.assertTrue(dict.__getitem__(opt, 'item').__class__ is not dict)
+    self.assertEqual(opt['item']['two'], {'value' : '2'})
+    self.assertEqual(cPickle.loads(cPickle.dumps(opt, 2)), XMLin(xml))
+    self.assertRaises(ValueError, XMLin, xml, {'lazy' : 1, 'engine' : 'onepass'})
+
+  def testSelectSkip(self):
+    xml = '''
+    <opt version="1">
+      <item name="one"><option>x</option><debug><dump>1</dump></debug></item>
+      <item name="two"><option>y</option><raw>bytes</raw></item>
+      <debug>log</debug>
+      <other>o</other>
+    </opt>
+    '''
+    for parser in ('sax', 'expat', 'iterparse'):
+      options = {'parser' : parser}
+      opt = XMLin(xml, dict(options, skip=['**/debug', 'opt/item/raw']))
+      self.assertEqual(opt, {
+        'version' : '1',
+        'item'    : {'one' : {'option' : 'x'}, 'two' : {'option' : 'y'}},
+        'other'   : 'o'})
+
+      # elements on the way to selected ones keep their attributes
+      opt = XMLin(xml, dict(options, select='opt/item/opt*'))
+      self.assertEqual(opt, {
+        'version' : '1',
+        'item'    : {'one' : {'option' : 'x'}, 'two' : {'option' : 'y'}}})
+
+      opt = XMLin(xml, dict(options, select='*/item', skip='**/debug'))
+      self.assertEqual(opt['item']['two'], {'option' : 'y', 'raw' : 'bytes'})
+      self.assertEqual(opt['item']['one'], {'option' : 'x'})
+
+    # the steps remembered are bounded, whatever names come in
+    conv = Converter({'skip' : '**/debug'})
+    for i in range(DefPathSteps + 10):
+      conv.loads('<opt><name%d>x</name%d></opt>' % (i, i))
+    self.assertTrue(len(conv.opt_in['skip'].steps) <= DefPathSteps)
+
+  def testPushParser(self):
+    xml = '''
+    <opt>
+      <item name="one"><value>1</value></item>
+      <item name="two"><value>バリュー</value></item>
+    </opt>
+    '''
+    for parser in ('sax', 'expat'):
+      for engine in ('tree', 'onepass'):
+        options = {'parser' : parser, 'engine' : engine}
+        push = PushParser(options)
+        for i in range(0, len(xml), 5):
+          self.assertEqual(push.feed(xml[i:i+5]), [])
+        self.assertEqual(push.close(), XMLin(xml))
+
+        # records are handed out as soon as they are complete
+        push = PushParser(options, 'opt/item')
+        records = push.feed(xml[:xml.index('<item name="two"')])
+        self.assertEqual(records, [{'name' : 'one', 'value' : '1'}])
+        records = push.feed(xml[xml.index('<item name="two"'):])
+        records.extend(push.close())
+        self.assertEqual(records, [{'name' : 'two', 'value' : u'バリュー'}])
+    self.assertRaises(ValueError, PushParser, {'parser' : 'iterparse'})
+
+    # after an error the parser is dead, and says so
+    for parser in ('sax', 'expat'):
+      push = PushParser({'parser' : parser})
+      self.assertRaises(Exception, push.feed, '<opt><a></b>')
+      self.assertRaises(ValueError, push.feed, 'x')
+      self.assertRaises(ValueError, push.close)
+      push = PushParser({'parser' : parser})
+      push.feed('<opt><a>')
+      self.assertRaises(Exception, push.close)
+      self.assertRaises(ValueError, push.close)
+
+  def testCache(self):
+    xml = '<opt><item name="one" value="1" /><item name="two" value="2" /></opt>'
+    MemCache.clear()
+    shared = XMLin(xml, {'cache' : 'memshare'})
+    self.assertEqual(shared, XMLin(xml))
+    self.assertTrue(XMLin(xml, {'cache' : 'memshare'}) is shared)
+    # other options make another entry, the parser does not
+    self.assertTrue(XMLin(xml, {'cache' : 'memshare', 'parser' : 'expat'}) is shared)
+    self.assertTrue(XMLin(xml, {'cache' : 'memshare', 'keyattr' : []}) is not shared)
+    self.assertEqual((MemCache.hits, MemCache.misses), (2, 2))
+
+    # each scheme is looked into in turn
+    self.assertTrue(XMLin(xml, {'cache' : ['memcopy', 'memshare']}) is shared)
+    copied = XMLin(xml, {'cache' : 'memcopy'})
+    self.assertEqual(copied, shared)
+    self.assertTrue(copied is not shared)
+    self.assertTrue(XMLin(xml, {'cache' : 'memcopy'}) is not copied)
+
+    # the least recently used entries are dropped
+    MemCache.clear()
+    MemCache.maxentries = 2
+    try:
+      for i in range(3):
+        XMLin('<opt><n>%d</n></opt>' % i, {'cache' : 'memshare'})
+      self.assertEqual((len(MemCache), MemCache.evictions), (2, 1))
+    finally:
+      MemCache.maxentries = 256
+      MemCache.clear()
+    self.assertRaises(ValueError, XMLin, xml, {'cache' : 'nocache'})
+
+    # XMLin_file caches by path, sources which can not be cached warn
+    # and the incremental interfaces refuse the option
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    try:
+      os.write(fd, xml)
+      os.close(fd)
+      for mmap in (True, False):
+        MemCache.clear()
+        tree = XMLin_file(path, {'cache' : 'memshare'}, mmap=mmap)
+        self.assertEqual(tree, shared)
+        self.assertTrue(XMLin_file(path, {'cache' : 'memshare'}, mmap=mmap) is tree)
+    finally:
+      os.remove(path)
+    warnings.simplefilter('error')
+    try:
+      self.assertRaises(UserWarning, XMLin, iter([xml]), {'cache' : 'memshare'})
+    finally:
+      warnings.resetwarnings()
+    self.assertRaises(ValueError, PushParser, {'cache' : 'memshare'})
+    self.assertRaises(ValueError, list, XMLiter(xml, 'opt/item', {'cache' : 'memshare'}))
+
+  def testPublish(self):
+    tree = XMLin('<opt><item name="one" value="1" /><item name="two" />'
+                 '<list>a</list><list>b</list><empty /></opt>')
+    tree['numbers'] = [1, 2.5, True, None, u'\u3042']
+    path = publish(tree, 'pyxml2obj-test-%d' % os.getpid())
+    try:
+      view = attach(path)
+      self.assertEqual(view, tree)
+      self.assertEqual(view['item']['one']['value'], '1')
+      self.assertEqual(view['list'][-1], 'b')
+      self.assertEqual(view['numbers'][1:], [2.5, True, None, u'\u3042'])
+      self.assertTrue('empty' in view)
+      self.assertFalse('other' in view)
+      self.assertRaises(KeyError, lambda: view['other'])
+      self.assertEqual(materialize(view), tree)
+      self.assertEqual(XMLout(view['item']), XMLout(tree['item']))
+    finally:
+      os.remove(path)
+    self.assertRaises(TypeError, publish, {'a' : {1 : 'b'}}, path)
+    self.assertFalse(os.path.exists(path))
+
+  def testStorable(self):
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'catalog.xml')
+    stor = os.path.join(tempdir, 'catalog.stor')
+    cachedir = os.path.join(tempdir, 'cache')
+    os.mkdir(cachedir)
+    try:
+      fp = open(path, 'w')
+      fp.write('<opt><item name="one" value="1" /></opt>')
+      fp.close()
+      expected = XMLin(path)
+      self.assertEqual(XMLin(path, {'cache' : 'storable'}), expected)
+      self.assertTrue(os.path.exists(stor))
+      self.assertEqual(XMLin(path, {'cache' : 'storable'}), expected)
+
+      # the snapshot is only used for the same options and file
+      self.assertEqual(XMLin(path, {'cache' : 'storable', 'keyattr' : []}),
+                       XMLin(path, {'keyattr' : []}))
+      fp = open(path, 'w')
+      fp.write('<opt><item name="two" value="2" /><other /></opt>')
+      fp.close()
+      self.assertEqual(XMLin(path, {'cache' : 'storable'}), XMLin(path))
+
+      # a broken snapshot is a miss
+      fp = open(stor, 'w')
+      fp.write('broken')
+      fp.close()
+      self.assertEqual(XMLin(path, {'cache' : 'storable'}), XMLin(path))
+
+      options = {'cache' : 'storable', 'cachedir' : cachedir}
+      self.assertEqual(XMLin(path, options), XMLin(path))
+      self.assertEqual(len(os.listdir(cachedir)), 1)
+      self.assertEqual(XMLin(path, options), XMLin(path))
+    finally:
+      shutil.rmtree(tempdir)
+
 if __name__ == '__main__':
   unittest.main()
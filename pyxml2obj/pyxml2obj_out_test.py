@@ -3,7 +3,9 @@
 
 import re
 import unittest
-from pyxml2obj import XMLin, XMLout
+from collections import OrderedDict
+from StringIO import StringIO
+from pyxml2obj import XMLin, XMLout, XMLout_iter, XMLout_many, Converter
 
 class XML2objOutTest(unittest.TestCase):
   def testScalar(self):
@@ -165,6 +167,22 @@ class XML2objOutTest(unittest.TestCase):
     self.assert_(re.search(r'b=""B""', xml))
     self.assert_(re.search(r'<c>&C&</c>', xml))
 
+    # quotes are left alone in text
+    tree = { 'a' : '<A>', 'b' : ['"B"', '&C&'], 'content' : 'x"y' }
+    expected = \
+'''<root a="&lt;A&gt;">x"y  <b>"B"</b>
+  <b>&amp;C&amp;</b>
+</root>
+'''
+    self.assertEqual(XMLout(tree), expected)
+
+    # same result with the cache of escaped values
+    self.assertEqual(XMLout(tree, {'escapecache' : 1}), expected)
+    self.assertEqual(XMLout(tree, {'escapecache' : 100}), expected)
+
+    # unicode is escaped as is
+    self.assertEqual(XMLout({'a' : u'\u30d0&'}), u'<root a="\u30d0&amp;" />\n')
+
   def test_circular_data(self):
     tree = {'a': '1'}
     tree['b'] = tree
@@ -174,6 +192,18 @@ class XML2objOutTest(unittest.TestCase):
     except:
       pass
 
+  def test_shared_data(self):
+    # the same or equal subtrees in several places are not circular
+    shared = {'a' : '1'}
+    tree = {'x' : shared, 'y' : shared, 'z' : [{'a' : '1'}, {'a' : '1'}]}
+    xml = XMLout(tree)
+    self.assertEqual(XMLin(xml), tree)
+
+    # circular list is detected
+    tree = {'list' : ['a']}
+    tree['list'].append(tree['list'])
+    self.assertRaises(ValueError, XMLout, tree)
+
   def test_complex_hash(self):
     tree = {
       'car' : {
@@ -343,6 +373,126 @@ r'''^<(\w+)>\s*
                         'keyattr' : {'dir' : 'name'}, 'contentkey' : '-content'})
     self.assert_(re.match(expected, xml, re.VERBOSE))
     
+  def test_file(self):
+    tree = {
+      'car' : {
+        'LW1804' : { 'id' : 2, 'make' : 'GM' },
+        'SH6673' : { 'id' : 1, 'make' : 'Ford', 'option' : ['a', 'b'] },
+        },
+      u'name' : u'value',
+      }
+    options = {'keyattr' : {'car' : 'license'}, 'xmldecl' : 1}
+    fp = StringIO()
+    self.assertEqual(XMLout(tree, options, file=fp), None)
+    self.assertEqual(fp.getvalue(), XMLout(tree, options).encode('utf-8'))
+
+    # deep tree is written without running out of stack
+    tree = {'value' : '1'}
+    for i in range(2000):
+      tree = {'level' : tree}
+    fp = StringIO()
+    XMLout(tree, {'keyattr' : []}, file=fp)
+    self.assertEqual(fp.getvalue().count('<level>'), 1999)
+
+  def test_iter(self):
+    tree = {'item' : [{'id' : str(i), 'name' : u'item%d' % i} for i in range(1000)]}
+    options = {'keyattr' : [], 'xmldecl' : 1}
+    xml = XMLout(tree, options)
+    chunks = list(XMLout_iter(tree, options, chunk_size=512))
+    self.assertEqual(''.join(chunks), xml.encode('utf-8'))
+    self.assertTrue(len(chunks) > 1)
+    for chunk in chunks[:-1]:
+      self.assertTrue(isinstance(chunk, str) and len(chunk) >= 512)
+
+    # small document fits into a single chunk
+    self.assertEqual(list(XMLout_iter({'one' : 1})), [XMLout({'one' : 1})])
+
+  def test_converter(self):
+    options = {'keyattr' : {'country' : '+name'}, 'forcearray' : ['country']}
+    conv = Converter(options)
+    tree = { 'country' : {
+      'England' : { 'capital' : 'London' },
+      'France'  : { 'capital' : 'Paris' },
+      }}
+    for i in range(3):
+      xml = conv.dumps(tree)
+      self.assertEqual(xml, XMLout(tree, {'keyattr' : {'country' : '+name'}}))
+      self.assertEqual(conv.loads(xml), {'country' : {
+        'England' : { 'capital' : 'London', 'name' : 'England' },
+        'France'  : { 'capital' : 'Paris', 'name' : 'France' },
+        }})
+
+    # options given by the caller are left untouched
+    self.assertEqual(options['keyattr'], {'country' : '+name'})
+
+    # and normalized ones can not be changed
+    self.assertRaises(TypeError, conv.opt_in.__setitem__, 'rootname', 'x')
+
+    # keeproot does not leak into the next call
+    conv = Converter({'keeproot' : 1})
+    self.assertTrue(conv.dumps({'one' : {'a' : '1'}}).startswith('<one '))
+    self.assertTrue(conv.dumps({'two' : {'a' : '1'}}).startswith('<two '))
+
+  def test_many(self):
+    trees = [{'item' : {'name' : 'n%d' % i, 'value' : str(i)}} for i in range(20)]
+    expected = [XMLout(tree, {'keyattr' : []}) for tree in trees]
+    self.assertEqual(list(XMLout_many(trees, {'keyattr' : []}, workers=2)), expected)
+
+    # the counters of the workers come back to the caller
+    stats = {}
+    list(XMLout_many(trees, {'keyattr' : [], 'stats' : stats}, workers=2))
+    self.assertEqual(stats['calls'], 20)
+    self.assertEqual(stats['chars'], sum(map(len, expected)))
+
+  def test_order(self):
+    items = [OrderedDict([('b', '1'), ('c', '2'), ('a', '3')]),
+             OrderedDict([('b', '4'), ('c', '5'), ('a', '6')]),
+             OrderedDict([('c', '7'), ('a', '8')])]
+    tree = {'item' : items}
+    self.assertEqual(XMLout(tree), XMLout({'item' : [dict(item) for item in items]}))
+    self.assertEqual(XMLout(tree, {'rootname' : 'opt'}), '''<opt>
+  <item a="3" b="1" c="2" />
+  <item a="6" b="4" c="5" />
+  <item a="8" c="7" />
+</opt>
+''')
+    self.assertEqual(XMLout(tree, {'rootname' : 'opt', 'order' : 'insertion'}), '''<opt>
+  <item b="1" c="2" a="3" />
+  <item b="4" c="5" a="6" />
+  <item c="7" a="8" />
+</opt>
+''')
+    # keys not listed follow the listed ones, sorted
+    order = {'item' : ['c', 'x', 'b']}
+    self.assertEqual(XMLout(tree, {'rootname' : 'opt', 'order' : order}), '''<opt>
+  <item c="2" b="1" a="3" />
+  <item c="5" b="4" a="6" />
+  <item c="7" a="8" />
+</opt>
+''')
+
+    # the key attribute comes first in any order
+    tree = {'item' : {'one' : {'b' : '1', 'a' : '2'}}}
+    self.assertEqual(XMLout(tree, {'keyattr' : {'item' : 'name'}, 'order' : {'item' : ['a']}}),
+                     '<root>\n  <item name="one" a="2" b="1" />\n</root>\n')
+    self.assertRaises(ValueError, XMLout, tree, {'order' : 'reversed'})
+
+  def test_keyattr_unfold(self):
+    # the key attribute is written with the keys of each value, which
+    # are left as they are
+    tree = {'item' : OrderedDict([('one', {'b' : '1', 'name' : 'old'}),
+                                  ('two', OrderedDict([('c', '2'), ('a', '3')]))])}
+    self.assertEqual(XMLout(tree, {'keyattr' : ['name'], 'rootname' : 'opt'}), '''<opt>
+  <item b="1" name="one" />
+  <item a="3" c="2" name="two" />
+</opt>
+''')
+    self.assertEqual(tree['item']['one'], {'b' : '1', 'name' : 'old'})
+    self.assertEqual(XMLout(tree, {'keyattr' : {'item' : 'name'}, 'order' : 'insertion'}), '''<root>
+  <item name="one" b="1" />
+  <item name="two" c="2" a="3" />
+</root>
+''')
 
 if __name__ == '__main__':
   unittest.main()
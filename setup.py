@@ -26,7 +26,7 @@ if __name__ == '__main__':
     
   # build distribution package
   setup(
-    packages         = ('pyxml2obj',),
+    packages         = ('pyxml2obj', 'pyxml2obj.bench'),
     name             = 'pyxml2obj',
     version          = __version__,
     py_modules       = ['pyxml2obj', 'pyxml2obj_in_test', 'pyxml2obj_out_test'],